@@ -0,0 +1,135 @@
+import ipaddress
+
+# Special-purpose ranges (IANA IPv4/IPv6 special-purpose registries) that ipapi.co can only answer with an error
+SPECIAL_NETWORKS = [(ipaddress.ip_network(network), reason) for network, reason in [
+    ('0.0.0.0/8', 'Unspecified / "this network" address'),
+    ('10.0.0.0/8', 'Private address (RFC 1918)'),
+    ('100.64.0.0/10', 'Carrier-grade NAT shared address (RFC 6598)'),
+    ('127.0.0.0/8', 'Loopback address'),
+    ('169.254.0.0/16', 'Link-local address'),
+    ('172.16.0.0/12', 'Private address (RFC 1918)'),
+    ('192.0.0.0/24', 'IETF protocol assignment'),
+    ('192.0.2.0/24', 'Documentation address (TEST-NET-1)'),
+    ('192.88.99.0/24', 'Deprecated 6to4 relay anycast address'),
+    ('192.168.0.0/16', 'Private address (RFC 1918)'),
+    ('198.18.0.0/15', 'Benchmarking address'),
+    ('198.51.100.0/24', 'Documentation address (TEST-NET-2)'),
+    ('203.0.113.0/24', 'Documentation address (TEST-NET-3)'),
+    ('224.0.0.0/4', 'Multicast address'),
+    ('240.0.0.0/4', 'Reserved address'),
+    ('255.255.255.255/32', 'Limited broadcast address'),
+    ('::/128', 'Unspecified address'),
+    ('::1/128', 'Loopback address'),
+    ('::/96', 'Deprecated IPv4-compatible address'),
+    ('64:ff9b:1::/48', 'Local-use IPv4/IPv6 translation address'),
+    ('100::/64', 'Discard-only address'),
+    ('2001:2::/48', 'Benchmarking address'),
+    ('2001:10::/28', 'Deprecated ORCHID address'),
+    ('2001:20::/28', 'ORCHIDv2 address'),
+    ('2001:db8::/32', 'Documentation address'),
+    ('3fff::/20', 'Documentation address'),
+    ('fc00::/7', 'Unique local address'),
+    ('fe80::/10', 'Link-local address'),
+    ('fec0::/10', 'Deprecated site-local address'),
+    ('ff00::/8', 'Multicast address'),
+]]
+# Most specific first, so e.g. the broadcast address is not reported as merely reserved
+SPECIAL_NETWORKS.sort(key=lambda item: item[0].prefixlen, reverse=True)
+
+
+# RFC 6052 well-known NAT64 prefix; the last 32 bits are the IPv4 address being reached
+NAT64_PREFIX = ipaddress.ip_network('64:ff9b::/96')
+
+
+def parse(ip):
+    # Normalizes user input to the address it actually designates, so equivalent spellings share cache keys:
+    # surrounding whitespace, [brackets] and %zone ids are dropped, and IPv6 addresses that merely carry an IPv4
+    # address (IPv4-mapped, 6to4, Teredo client, NAT64 well-known prefix) are unwrapped to it.
+    # Raises ValueError for anything that is not a single IPv4 or IPv6 address
+    text = (ip or '').strip()
+    if text.startswith('[') and text.endswith(']'):
+        text = text[1:-1]
+    address = ipaddress.ip_address(text.split('%', 1)[0])
+    if address.version == 6:
+        if address.ipv4_mapped:
+            return address.ipv4_mapped
+        if address.sixtofour:
+            return address.sixtofour
+        if address.teredo:
+            return address.teredo[1]
+        if address in NAT64_PREFIX:
+            return ipaddress.IPv4Address(int(address) & 0xFFFFFFFF)
+    return address
+
+
+def special_use(address):
+    # Reason the address has no public geolocation, or None for globally routable addresses. Ranges without a
+    # named reason above still fall back to ipaddress's view of the special-purpose registries
+    for network, reason in SPECIAL_NETWORKS:
+        if address.version == network.version and address in network:
+            return reason
+    if not address.is_global or address.is_reserved or (address.version == 6 and address.is_site_local):
+        return 'Reserved address'
+    return None
+
+
+def parse_networks(value):
+    # Comma-separated addresses / CIDR networks, e.g. a TRUSTED_PROXIES setting
+    return [ipaddress.ip_network(item.strip(), strict=False) for item in value.split(',') if item.strip()]
+
+
+def _node_address(node):
+    # Address part of a forwarding hop: drops quotes, [brackets] and ports ('"[2001:db8::1]:4711"', '192.0.2.1:80')
+    node = node.strip().strip('"')
+    if node.startswith('['):
+        return node[1:].split(']', 1)[0]
+    if node.count(':') == 1:
+        return node.split(':', 1)[0]
+    return node
+
+
+def forwarded_for(header):
+    # The for= hops of an RFC 7239 Forwarded header, client first
+    hops = []
+    for element in header.split(','):
+        for pair in element.split(';'):
+            name, _, value = pair.partition('=')
+            if name.strip().lower() == 'for':
+                hops.append(_node_address(value))
+    return hops
+
+
+def _is_trusted(ip, trusted_proxies):
+    try:
+        address = parse(ip)
+    except ValueError:
+        return False
+    return any(address.version == network.version and address in network for network in trusted_proxies)
+
+
+# Forwarding headers client_address understands, by lowercase name
+PROXY_HEADERS = ('forwarded', 'x-forwarded-for')
+
+
+def client_address(remote_addr, header, value, trusted_proxies):
+    # Walks the proxy chain from the nearest hop outwards for as long as hops are trusted proxies; the first hop
+    # that is not one is the client. Forwarding headers are ignored unless the direct peer is trusted, so clients
+    # cannot spoof their address. `header` names the one header ('forwarded' or 'x-forwarded-for') the trusted
+    # proxies maintain; any other forwarding header is whatever the client sent and is never looked at
+    if header == 'forwarded':
+        hops = forwarded_for(value or '')
+    elif header == 'x-forwarded-for':
+        hops = [_node_address(hop) for hop in (value or '').split(',') if hop.strip()]
+    else:
+        raise ValueError(f"Unsupported proxy header {header!r}")
+    client = remote_addr
+    for hop in reversed(hops):
+        if not _is_trusted(client, trusted_proxies):
+            break
+        try:
+            parse(hop)
+        except ValueError:
+            # 'unknown' or an obfuscated identifier: the chain cannot be followed further
+            break
+        client = hop
+    return client
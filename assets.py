@@ -0,0 +1,88 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import posixpath
+import re
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Files under STATIC_DIR are served at /assets/<name>.<content hash>.<ext>, so a URL never changes meaning and
+# browsers and CDNs may keep it forever
+STATIC_DIR = os.environ.get('STATIC_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'))
+# Hex digits of the content hash kept in fingerprinted names
+ASSET_HASH_LENGTH = 12
+# Precompressed variants are only kept when they save at least this fraction of the original size
+ASSET_MIN_SAVING = 0.1
+
+# Not in the built-in table of older Pythons; without it fonts would be served as application/octet-stream
+mimetypes.add_type('font/woff2', '.woff2')
+
+_CSS_URL = re.compile(r'url\(([\'"]?)([^\'")]+)\1\)')
+
+
+class Asset:
+    # One static file, with its precompressed variants keyed by content coding ('identity', 'gzip', 'br')
+
+    def __init__(self, name, data):
+        self.name = name
+        self.digest = hashlib.sha256(data).hexdigest()[:ASSET_HASH_LENGTH]
+        self.mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        base, ext = os.path.splitext(name)
+        self.fingerprinted = f"{base}.{self.digest}{ext}"
+        self.variants = {'identity': data}
+        compressed = {'gzip': gzip.compress(data, 9, mtime=0)}
+        if brotli is not None:
+            compressed['br'] = brotli.compress(data, quality=11)
+        for coding, body in compressed.items():
+            if len(body) <= len(data) * (1 - ASSET_MIN_SAVING):
+                self.variants[coding] = body
+
+    def etag(self, coding):
+        return self.digest if coding == 'identity' else f"{self.digest}-{coding}"
+
+
+class Manifest:
+    # Every static file read, hashed and compressed once at startup, looked up by original or fingerprinted name
+
+    def __init__(self, root):
+        self.root = root
+        self.assets = {}
+        self.by_fingerprint = {}
+        names = []
+        if os.path.isdir(root):
+            for directory, _, files in os.walk(root):
+                for filename in files:
+                    names.append(os.path.relpath(os.path.join(directory, filename), root).replace(os.sep, '/'))
+        # Stylesheets last, so the files they refer to already have their fingerprinted names
+        for name in sorted(names, key=lambda name: name.endswith('.css')):
+            with open(os.path.join(root, name), 'rb') as f:
+                data = f.read()
+            if name.endswith('.css'):
+                data = self._rewrite_urls(name, data.decode('utf-8')).encode('utf-8')
+            asset = Asset(name, data)
+            self.assets[name] = asset
+            self.by_fingerprint[asset.fingerprinted] = asset
+
+    def _rewrite_urls(self, name, css):
+        # Relative url(...) references to other static files point at their fingerprinted names
+        directory = posixpath.dirname(name)
+
+        def rewrite(match):
+            target = posixpath.normpath(posixpath.join(directory, match.group(2)))
+            if target not in self.assets:
+                return match.group(0)
+            return f"url({posixpath.relpath(self.assets[target].fingerprinted, directory or '.')})"
+        return _CSS_URL.sub(rewrite, css)
+
+    def fingerprinted(self, name):
+        return self.assets[name].fingerprinted
+
+    def find(self, fingerprinted):
+        return self.by_fingerprint.get(fingerprinted)
+
+
+manifest = Manifest(STATIC_DIR)
@@ -0,0 +1,84 @@
+import gzip
+import os
+import zlib
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Responses smaller than this many bytes are sent as they are; compressing them saves less than the header costs
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', '500'))
+# gzip level (1-9) and brotli quality (0-11); on-the-fly compression favours speed over the last few percent
+COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', '6'))
+COMPRESS_BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', '4'))
+# Content types worth compressing; images and other already-compressed formats are left alone
+COMPRESS_MIMETYPES = set(os.environ.get(
+    'COMPRESS_MIMETYPES',
+    'text/html,text/css,text/plain,application/json,application/x-ndjson,application/javascript,image/svg+xml',
+).split(','))
+
+_CODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def _compressor(coding):
+    # (compress(chunk), flush(), finish()) for one response body
+    if coding == 'br':
+        compressor = brotli.Compressor(quality=COMPRESS_BROTLI_QUALITY)
+        return compressor.process, compressor.flush, compressor.finish
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+
+
+def _compress_stream(chunks, coding):
+    # Every chunk is flushed as soon as it is compressed, so streamed results (NDJSON lines) are not held back
+    compress, flush, finish = _compressor(coding)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = compress(chunk) + flush()
+            if data:
+                yield data
+        yield finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def compress_response(response):
+    # after_request hook: encodes text responses in the best coding the client accepts
+    if response.mimetype not in COMPRESS_MIMETYPES:
+        return response
+    response.vary.add('Accept-Encoding')
+    if (response.content_encoding or response.direct_passthrough or response.status_code < 200
+            or response.status_code in (204, 304) or response.cache_control.no_transform):
+        return response
+    coding = request.accept_encodings.best_match(_CODINGS)
+    if coding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, coding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+        if coding == 'br':
+            body = brotli.compress(data, quality=COMPRESS_BROTLI_QUALITY)
+        else:
+            body = gzip.compress(data, COMPRESS_LEVEL, mtime=0)
+        if len(body) >= len(data):
+            return response
+        response.set_data(body)
+    response.content_encoding = coding
+    etag, weak = response.get_etag()
+    if etag:
+        # The view's conditional check saw the uncompressed ETag; clients revalidate with this one, so the check
+        # is repeated here or they would never get a 304
+        response.set_etag(f"{etag}-{coding}", weak)
+        response.make_conditional(request)
+    return response
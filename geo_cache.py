@@ -0,0 +1,182 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class TTLCache:
+    # Bounded LRU map whose entries expire ttl seconds after they were stored; expired entries are kept for another
+    # stale_ttl seconds so callers can still choose to serve them
+
+    def __init__(self, max_entries, ttl, stale_ttl=0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get_entry(self, key, max_stale=0):
+        # Returns (value, seconds past expiry; negative while fresh), or None when the key is missing or has been
+        # expired for longer than max_stale
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at = entry
+            stale_for = time.monotonic() - expires_at
+            if stale_for >= self.stale_ttl:
+                del self._entries[key]
+                self.expirations += 1
+            if stale_for > 0 and stale_for >= min(max_stale, self.stale_ttl):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            if stale_for > 0:
+                self.stale_hits += 1
+            else:
+                self.hits += 1
+            return value, stale_for
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'stale_ttl': self.stale_ttl,
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+
+class SQLiteCache:
+    # Persistent cache shared by every worker process on the host; WAL mode lets readers run alongside a writer
+
+    # Every `purge_every` writes, rows expired for longer than `purge_grace` seconds are deleted, so the file only
+    # holds entries that could still be served
+
+    def __init__(self, path, ttl, purge_every=1000, purge_grace=0):
+        self.path = path
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self.purge_grace = purge_grace
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.purged = 0
+
+    def _connection(self):
+        # sqlite3 connections must not be shared between threads, so each thread opens its own
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS geo ('
+                         'key TEXT PRIMARY KEY, payload TEXT NOT NULL, fetched_at REAL NOT NULL, ttl REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS geo_expires ON geo (fetched_at + ttl)')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key, max_stale=0):
+        # Returns (value, remaining ttl in seconds; negative once expired), or None when the key is missing or has
+        # been expired for longer than max_stale
+        row = self._connection().execute('SELECT payload, fetched_at, ttl FROM geo WHERE key = ?', (key,)).fetchone()
+        remaining = row[1] + row[2] - time.time() if row else None
+        with self._lock:
+            if remaining is None or (remaining <= 0 and -remaining >= max_stale):
+                self.misses += 1
+                return None
+            if remaining > 0:
+                self.hits += 1
+            else:
+                self.stale_hits += 1
+        return json.loads(row[0]), remaining
+
+    def set(self, key, value, ttl=None):
+        self._connection().execute('INSERT OR REPLACE INTO geo (key, payload, fetched_at, ttl) VALUES (?, ?, ?, ?)',
+                                   (key, json.dumps(value), time.time(), self.ttl if ttl is None else ttl))
+        with self._lock:
+            self._writes += 1
+            purge = self.purge_every and self._writes % self.purge_every == 0
+        if purge:
+            self.purge_expired(self.purge_grace)
+
+    def purge_expired(self, grace=0):
+        # Drops rows that have been expired for longer than grace seconds
+        purged = self._connection().execute('DELETE FROM geo WHERE fetched_at + ttl <= ?',
+                                            (time.time() - grace,)).rowcount
+        with self._lock:
+            self.purged += purged
+        return purged
+
+    def stats(self):
+        with self._lock:
+            return {'path': self.path, 'ttl': self.ttl, 'hits': self.hits, 'stale_hits': self.stale_hits,
+                    'misses': self.misses, 'purged': self.purged}
+
+
+class SingleFlight:
+    # Collapses concurrent calls for the same key into one; the other callers wait and share its result or exception
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key, fn, *args, timeout=None):
+        # Followers give up waiting after `timeout` seconds (concurrent.futures.TimeoutError); the call goes on
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = Future()
+                self.leaders += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+        if not leader:
+            return call.result(timeout)
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def stats(self):
+        with self._lock:
+            return {'in_flight': len(self._calls), 'leaders': self.leaders, 'coalesced': self.coalesced}
@@ -0,0 +1,231 @@
+import argparse
+import bisect
+import csv
+import ipaddress
+import math
+import mmap
+import struct
+from array import array
+
+# Fields answered for every address, named the way ipapi.co (and the page template) names them
+FIELDS = ('city', 'region', 'country_name', 'latitude', 'longitude', 'org', 'asn')
+STRING_FIELDS = ('city', 'region', 'country_name', 'org', 'asn')
+
+# Binary layout, all little-endian:
+#   header        magic, IPv4 range count, IPv6 range count, string count,
+#                 then file offsets of the IPv4 ranges, IPv6 ranges, string offset index and string data
+#   IPv4 ranges   fixed-width records: start, end (u32), latitude, longitude (f32, NaN when unknown),
+#                 then a string id (u32) for each of STRING_FIELDS; sorted by start, non-overlapping
+#   IPv6 ranges   the same, with start and end as 128-bit values split into high/low u64 halves
+#   string index  string count + 1 u32 offsets into the string data; string i is data[off[i]:off[i + 1]]
+#   string data   deduplicated UTF-8 strings, id 0 is the empty string
+MAGIC = b'GEODB\x00\x01\x00'
+HEADER = struct.Struct('<8sIIIQQQQ')
+RECORD_TAIL = '2f' + 'I' * len(STRING_FIELDS)
+IPV4_RECORD = struct.Struct('<II' + RECORD_TAIL)
+IPV6_RECORD = struct.Struct('<QQQQ' + RECORD_TAIL)
+STRING_OFFSET = struct.Struct('<I')
+
+
+class RangeTable:
+    # Non-overlapping [start, end] integer ranges sorted by start, with one record per range
+
+    def __init__(self, starts, ends, records):
+        self.starts = starts
+        self.ends = ends
+        self.records = records
+
+    @classmethod
+    def build(cls, rows, typecode=None):
+        # rows are (start, end, record) tuples in any order; IPv4 keys fit a compact unsigned array,
+        # IPv6 keys are 128-bit and stay Python ints
+        rows = sorted(rows, key=lambda row: row[0])
+        starts = [row[0] for row in rows]
+        ends = [row[1] for row in rows]
+        if typecode:
+            starts, ends = array(typecode, starts), array(typecode, ends)
+        return cls(starts, ends, [row[2] for row in rows])
+
+    def find(self, n):
+        i = bisect.bisect_right(self.starts, n) - 1
+        if i >= 0 and n <= self.ends[i]:
+            return self.records[i]
+        return None
+
+    def __len__(self):
+        return len(self.starts)
+
+
+def parse_range(row):
+    # A row names its range either as a CIDR 'network' or as inclusive 'start'/'end' addresses
+    if row.get('network'):
+        network = ipaddress.ip_network(row['network'].strip(), strict=False)
+        return network.version, int(network.network_address), int(network.broadcast_address)
+    start = ipaddress.ip_address(row['start'].strip())
+    end = ipaddress.ip_address(row['end'].strip())
+    if start.version != end.version or int(start) > int(end):
+        raise ValueError(f"Invalid range {row['start']} - {row['end']}")
+    return start.version, int(start), int(end)
+
+
+def read_csv(path):
+    # Yields (version, start, end, record) for each row of a range CSV with a header naming FIELDS
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            version, start, end = parse_range(row)
+            yield version, start, end, tuple((row.get(field) or '').strip() for field in FIELDS)
+
+
+def to_info(ip, record):
+    info = dict(zip(FIELDS, record))
+    info['ip'] = ip
+    for field in ('latitude', 'longitude'):
+        info[field] = float(info[field]) if info[field] not in (None, '') else None
+    return info
+
+
+class LocalGeoDB:
+    # Offline geolocation answered from in-memory range tables, one per address family
+
+    def __init__(self, ipv4, ipv6):
+        self.tables = {4: ipv4, 6: ipv6}
+
+    @classmethod
+    def from_csv(cls, path):
+        rows = {4: [], 6: []}
+        for version, start, end, record in read_csv(path):
+            rows[version].append((start, end, record))
+        return cls(RangeTable.build(rows[4], 'L'), RangeTable.build(rows[6]))
+
+    def lookup(self, ip):
+        # Returns the ipapi.co-shaped payload for ip, or None when no range covers it
+        address = ipaddress.ip_address(ip)
+        record = self.tables[address.version].find(int(address))
+        return to_info(str(address), record) if record is not None else None
+
+
+class MappedGeoDB:
+    # Reads the binary format through a read-only mmap, so every worker on the host shares one page-cache copy
+    # and lookups binary-search the mapped buffer in place
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.ipv4_count, self.ipv6_count, self.string_count,
+         self._ipv4_offset, self._ipv6_offset, self._index_offset, self._data_offset) = HEADER.unpack_from(self._mm)
+        if magic != MAGIC:
+            self._mm.close()
+            raise ValueError(f"{path} is not a geolocation database")
+
+    def close(self):
+        self._mm.close()
+
+    def _string(self, i):
+        start, = STRING_OFFSET.unpack_from(self._mm, self._index_offset + i * STRING_OFFSET.size)
+        end, = STRING_OFFSET.unpack_from(self._mm, self._index_offset + (i + 1) * STRING_OFFSET.size)
+        return str(self._mm[self._data_offset + start:self._data_offset + end], 'utf-8')
+
+    def _find(self, version, n):
+        # Last record whose start is <= n, then check n falls before its end
+        if version == 4:
+            record, base, count, width = IPV4_RECORD, self._ipv4_offset, self.ipv4_count, 2
+        else:
+            record, base, count, width = IPV6_RECORD, self._ipv6_offset, self.ipv6_count, 4
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if _key(record.unpack_from(self._mm, base + mid * record.size), width)[0] <= n:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == 0:
+            return None
+        fields = record.unpack_from(self._mm, base + (lo - 1) * record.size)
+        start, end = _key(fields, width)
+        return fields[width:] if n <= end else None
+
+    def lookup(self, ip):
+        address = ipaddress.ip_address(ip)
+        fields = self._find(address.version, int(address))
+        if fields is None:
+            return None
+        latitude, longitude = fields[:2]
+        info = dict(zip(STRING_FIELDS, (self._string(i) for i in fields[2:])))
+        info['ip'] = str(address)
+        # f32 keeps ~7 significant digits; four decimals (~10 m) is all the source data carries anyway
+        info['latitude'] = None if math.isnan(latitude) else round(latitude, 4)
+        info['longitude'] = None if math.isnan(longitude) else round(longitude, 4)
+        return info
+
+
+def _key(fields, width):
+    # (start, end) of an unpacked record; IPv6 bounds are stored as high/low u64 halves
+    if width == 2:
+        return fields[0], fields[1]
+    return fields[0] << 64 | fields[1], fields[2] << 64 | fields[3]
+
+
+def _coordinate(value):
+    return float(value) if value else math.nan
+
+
+def build(csv_path, out_path):
+    # Converts a range CSV (the format LocalGeoDB.from_csv reads) into the binary format MappedGeoDB maps
+    strings = {'': 0}
+    rows = {4: [], 6: []}
+    for version, start, end, record in read_csv(csv_path):
+        values = dict(zip(FIELDS, record))
+        ids = [strings.setdefault(values[field], len(strings)) for field in STRING_FIELDS]
+        rows[version].append((start, end, _coordinate(values['latitude']), _coordinate(values['longitude']), ids))
+
+    packed = {}
+    for version, record in ((4, IPV4_RECORD), (6, IPV6_RECORD)):
+        rows[version].sort(key=lambda row: row[0])
+        chunks = []
+        previous_end = -1
+        for start, end, latitude, longitude, ids in rows[version]:
+            if start <= previous_end:
+                raise ValueError(f"Overlapping IPv{version} ranges at {ipaddress.ip_address(start)}")
+            previous_end = end
+            bounds = (start, end) if version == 4 else (start >> 64, start & (2**64 - 1), end >> 64, end & (2**64 - 1))
+            chunks.append(record.pack(*bounds, latitude, longitude, *ids))
+        packed[version] = b''.join(chunks)
+
+    data = [s.encode('utf-8') for s in strings]
+    offsets = [0]
+    for encoded in data:
+        offsets.append(offsets[-1] + len(encoded))
+    index = b''.join(STRING_OFFSET.pack(offset) for offset in offsets)
+
+    ipv4_offset = HEADER.size
+    ipv6_offset = ipv4_offset + len(packed[4])
+    index_offset = ipv6_offset + len(packed[6])
+    data_offset = index_offset + len(index)
+    with open(out_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(rows[4]), len(rows[6]), len(strings),
+                            ipv4_offset, ipv6_offset, index_offset, data_offset))
+        f.write(packed[4])
+        f.write(packed[6])
+        f.write(index)
+        f.write(b''.join(data))
+    return len(rows[4]), len(rows[6]), len(strings)
+
+
+def open_db(path):
+    # Maps binary databases built by this module; anything else is read as a range CSV
+    with open(path, 'rb') as f:
+        magic = f.read(len(MAGIC))
+    return MappedGeoDB(path) if magic == MAGIC else LocalGeoDB.from_csv(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build a memory-mapped geolocation database from a range CSV.')
+    parser.add_argument('csv_path', help="CSV with 'network' or 'start'/'end' columns plus " + ', '.join(FIELDS))
+    parser.add_argument('out_path', help='Binary database to write')
+    args = parser.parse_args()
+    ipv4_count, ipv6_count, string_count = build(args.csv_path, args.out_path)
+    print(f"Wrote {args.out_path}: {ipv4_count} IPv4 ranges, {ipv6_count} IPv6 ranges, {string_count} strings")
+
+
+if __name__ == "__main__":
+    main()
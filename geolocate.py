@@ -0,0 +1,110 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import geolocation
+
+# Addresses handed to a worker process at a time by the local engine
+CHUNK_SIZE = 2000
+
+
+def _init_worker(engine, db_path):
+    geolocation.GEO_ENGINE = engine
+    geolocation.GEODB_PATH = db_path
+
+
+def _lookup_chunk(ips):
+    return [geolocation.lookup(ip) for ip in ips]
+
+
+def _chunks(ips, size):
+    chunk = []
+    for ip in ips:
+        chunk.append(ip)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def lookup_local(ips, workers):
+    # The local engine is CPU-bound, so chunks of addresses are spread over worker processes, each mapping the
+    # same database file; at most two chunks per worker are outstanding and results come back in input order
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(geolocation.GEO_ENGINE, geolocation.GEODB_PATH)) as pool:
+        queue = deque()
+        for chunk in _chunks(ips, CHUNK_SIZE):
+            queue.append(pool.submit(_lookup_chunk, chunk))
+            if len(queue) >= workers * 2:
+                yield from queue.popleft().result()
+        while queue:
+            yield from queue.popleft().result()
+
+
+def lookup_network(ips, workers, ordered):
+    # Network lookups are I/O-bound, so they fan out over threads through the same cached path the web app uses
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        yield from geolocation.lookup_stream(ips, ordered=ordered, window=workers * 4, pool=pool)
+
+
+def with_progress(results, out=sys.stderr, interval=1.0):
+    start = last = time.monotonic()
+    count = 0
+    for info in results:
+        count += 1
+        now = time.monotonic()
+        if now - last >= interval:
+            print(f"\r{count} addresses, {count / (now - start):.0f}/s", end='', file=out, flush=True)
+            last = now
+        yield info
+    elapsed = time.monotonic() - start
+    print(f"\r{count} addresses in {elapsed:.1f}s ({count / elapsed if elapsed else 0:.0f}/s)", file=out)
+
+
+def write_results(results, out, fmt):
+    if fmt == 'jsonl':
+        for info in results:
+            out.write(json.dumps(geolocation.compact(info)) + '\n')
+        return
+    writer = csv.DictWriter(out, fieldnames=geolocation.COMPACT_FIELDS, delimiter='\t' if fmt == 'tsv' else ',',
+                            extrasaction='ignore', lineterminator='\n')
+    writer.writeheader()
+    for info in results:
+        writer.writerow(info)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Geolocate IP addresses in bulk, one address per input line.')
+    parser.add_argument('input', nargs='?', default='-', help='File of addresses (default: stdin)')
+    parser.add_argument('-o', '--output', default='-', help='Output file (default: stdout)')
+    parser.add_argument('-f', '--format', choices=('csv', 'jsonl', 'tsv'), default='csv')
+    parser.add_argument('--engine', choices=('network', 'local'), default=geolocation.GEO_ENGINE)
+    parser.add_argument('--db', default=geolocation.GEODB_PATH, help='Database for the local engine')
+    parser.add_argument('-j', '--workers', type=int,
+                        help='Worker processes (local engine, default: CPU count) or threads (default: 8)')
+    parser.add_argument('--unordered', action='store_true',
+                        help='Write network results as they complete instead of in input order')
+    parser.add_argument('-q', '--quiet', action='store_true', help='No progress or throughput on stderr')
+    args = parser.parse_args()
+
+    geolocation.GEO_ENGINE = args.engine
+    geolocation.GEODB_PATH = args.db
+    source = sys.stdin if args.input == '-' else open(args.input, encoding='utf-8')
+    out = sys.stdout if args.output == '-' else open(args.output, 'w', newline='', encoding='utf-8')
+    with source, out:
+        ips = (line.strip() for line in source if line.strip())
+        if args.engine == 'local':
+            results = lookup_local(ips, args.workers or os.cpu_count() or 1)
+        else:
+            results = lookup_network(ips, args.workers or geolocation.BULK_LOOKUP_WORKERS, not args.unordered)
+        write_results(results if args.quiet else with_progress(results), out, args.format)
+
+
+if __name__ == "__main__":
+    main()
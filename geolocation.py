@@ -0,0 +1,288 @@
+import ipaddress
+import os
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, TimeoutError, wait
+
+import addresses
+import geodb
+import providers
+import ratelimit
+import upstream
+from geo_cache import SingleFlight, SQLiteCache, TTLCache
+
+# Upper bound on cached addresses and how long (seconds) a geolocation result is trusted
+GEO_CACHE_MAX_ENTRIES = int(os.environ.get('GEO_CACHE_MAX_ENTRIES', '10000'))
+GEO_CACHE_TTL = float(os.environ.get('GEO_CACHE_TTL', '86400'))
+
+# For GEO_CACHE_STALE_WHILE_REVALIDATE seconds after expiry a cached result is still served immediately while a
+# background refresh fetches a new one; for GEO_CACHE_STALE_IF_ERROR seconds it is served when upstream fails
+GEO_CACHE_STALE_WHILE_REVALIDATE = float(os.environ.get('GEO_CACHE_STALE_WHILE_REVALIDATE', '3600'))
+GEO_CACHE_STALE_IF_ERROR = float(os.environ.get('GEO_CACHE_STALE_IF_ERROR', '604800'))
+
+# Results are cached per network rather than per address: every address in the same IPv4 /24 (IPv6 /48) shares
+# one entry. Set to 32 / 128 to cache exact addresses only
+GEO_CACHE_IPV4_PREFIX = int(os.environ.get('GEO_CACHE_IPV4_PREFIX', '24'))
+GEO_CACHE_IPV6_PREFIX = int(os.environ.get('GEO_CACHE_IPV6_PREFIX', '48'))
+
+# SQLite file shared by all workers on the host so lookups survive restarts; set to an empty string to disable
+GEO_CACHE_DB = os.environ.get('GEO_CACHE_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'geo_cache.sqlite3'))
+# Rows that can no longer be served, even as stale-if-error, are deleted from it once every this many writes
+GEO_CACHE_PURGE_EVERY = int(os.environ.get('GEO_CACHE_PURGE_EVERY', '1000'))
+
+# 'network' geolocates through the upstream providers; 'local' answers offline from the database at GEODB_PATH, either a binary
+# file built with `python geodb.py` (memory-mapped) or a range CSV
+GEO_ENGINE = os.environ.get('GEO_ENGINE', 'network')
+GEODB_PATH = os.environ.get('GEODB_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'geodb.bin'))
+
+# Concurrent upstream lookups allowed for one bulk request, and how many results a streaming request may have
+# outstanding before it stops reading more input
+BULK_LOOKUP_WORKERS = int(os.environ.get('BULK_LOOKUP_WORKERS', '8'))
+STREAM_LOOKUP_WINDOW = int(os.environ.get('STREAM_LOOKUP_WINDOW', str(BULK_LOOKUP_WORKERS * 4)))
+
+# Fields kept in bulk API answers
+COMPACT_FIELDS = ('ip', 'city', 'region', 'country_name', 'latitude', 'longitude', 'org', 'asn', 'error', 'reason')
+
+# SQLite file holding the providers' request budgets, shared by every worker process on the host so that N workers
+# together stay within each provider's quota; set to an empty string to give each process its own budget
+GEO_RATE_STATE = os.environ.get('GEO_RATE_STATE', os.path.join(
+    os.path.dirname(GEO_CACHE_DB or os.path.abspath(__file__)), 'geo_ratelimit.sqlite3'))
+
+# Upstream geolocation providers to route between, by name (see providers.PROVIDERS); each has its own request
+# budget configured through <NAME>_RATE, <NAME>_BURST, ... (see providers.from_env)
+GEO_PROVIDERS = [name.strip() for name in os.environ.get('GEO_PROVIDERS', 'ipapi,ipwhois').split(',') if name.strip()]
+# A provider failing this many times in a row is skipped for GEO_PROVIDER_COOLDOWN seconds
+GEO_PROVIDER_FAILURES = int(os.environ.get('GEO_PROVIDER_FAILURES', '5'))
+GEO_PROVIDER_COOLDOWN = float(os.environ.get('GEO_PROVIDER_COOLDOWN', '30'))
+# Providers whose recent error rate (0-1) is above this are only tried after the healthier ones
+GEO_PROVIDER_MAX_ERROR_RATE = float(os.environ.get('GEO_PROVIDER_MAX_ERROR_RATE', '0.5'))
+# Hedged lookups: a request still unanswered after the provider's p95 latency is duplicated to another provider,
+# for at most GEO_HEDGE_RATIO of all lookups
+GEO_HEDGE = os.environ.get('GEO_HEDGE', '0') == '1'
+GEO_HEDGE_RATIO = float(os.environ.get('GEO_HEDGE_RATIO', '0.05'))
+# Threads that run the primary request of lookups that may be hedged; defaults to the app's upstream callers (page
+# lookups, the bulk pool and background refreshes). Lookups beyond it simply run unhedged on the caller's thread
+GEO_HEDGE_PRIMARY_WORKERS = int(os.environ.get(
+    'GEO_HEDGE_PRIMARY_WORKERS', str(upstream.UPSTREAM_POOL_SIZE + BULK_LOOKUP_WORKERS + 2)))
+# Page loads wait at most UPSTREAM_INTERACTIVE_WAIT seconds for a request slot and jump ahead of bulk lookups,
+# which wait up to UPSTREAM_BULK_WAIT
+UPSTREAM_INTERACTIVE_WAIT = float(os.environ.get('UPSTREAM_INTERACTIVE_WAIT', '5'))
+UPSTREAM_BULK_WAIT = float(os.environ.get('UPSTREAM_BULK_WAIT', '60'))
+
+cache = TTLCache(GEO_CACHE_MAX_ENTRIES, GEO_CACHE_TTL,
+                 max(GEO_CACHE_STALE_WHILE_REVALIDATE, GEO_CACHE_STALE_IF_ERROR))
+disk_cache = SQLiteCache(GEO_CACHE_DB, GEO_CACHE_TTL, GEO_CACHE_PURGE_EVERY, GEO_CACHE_STALE_IF_ERROR) if GEO_CACHE_DB else None
+# Concurrent misses for the same network wait on a single upstream fetch instead of stampeding the providers
+flights = SingleFlight()
+bulk_pool = ThreadPoolExecutor(max_workers=BULK_LOOKUP_WORKERS)
+# Background refreshes of stale entries, at most one per cache key at a time
+refresh_pool = ThreadPoolExecutor(max_workers=2)
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+router = providers.Router([providers.from_env(name, GEO_RATE_STATE) for name in GEO_PROVIDERS],
+                          GEO_PROVIDER_FAILURES, GEO_PROVIDER_COOLDOWN, GEO_HEDGE, GEO_HEDGE_RATIO,
+                          max_error_rate=GEO_PROVIDER_MAX_ERROR_RATE, primary_workers=GEO_HEDGE_PRIMARY_WORKERS)
+
+
+_local_db = None
+_local_db_lock = threading.Lock()
+
+
+def local_db():
+    # Loaded on first use so the network engine never pays for reading the range database
+    global _local_db
+    if _local_db is None:
+        with _local_db_lock:
+            if _local_db is None:
+                _local_db = geodb.open_db(GEODB_PATH)
+    return _local_db
+
+
+def local_lookup(ip):
+    info = local_db().lookup(ip)
+    return info or {'ip': ip, 'error': True, 'reason': 'Address not found in local database'}
+
+
+def fetch(ip, priority=ratelimit.INTERACTIVE, deadline=None):
+    wait = UPSTREAM_INTERACTIVE_WAIT if priority == ratelimit.INTERACTIVE else UPSTREAM_BULK_WAIT
+    return router.fetch(ip, priority, wait, deadline)
+
+
+def cache_key(address):
+    prefix = GEO_CACHE_IPV4_PREFIX if address.version == 4 else GEO_CACHE_IPV6_PREFIX
+    return str(ipaddress.ip_network((address, prefix), strict=False))
+
+
+def _answer_locally(ip):
+    # (address, info) where info is set when the answer needs no upstream call: malformed and special-use
+    # addresses, the local engine, and cache hits. Cached results belong to a whole network, so the 'ip' field
+    # is rewritten to the address asked about
+    try:
+        address = addresses.parse(ip)
+    except ValueError:
+        return None, {'ip': (ip or '').strip(), 'error': True, 'reason': 'Invalid IP Address'}
+    reason = addresses.special_use(address)
+    if reason:
+        return address, {'ip': str(address), 'error': True, 'reserved': True, 'reason': reason}
+    if GEO_ENGINE == 'local':
+        # Local lookups are already in-memory range searches, so the caches would only add overhead
+        return address, local_lookup(str(address))
+    key = cache_key(address)
+    entry = cache.get_entry(key, max_stale=GEO_CACHE_STALE_WHILE_REVALIDATE)
+    if entry is None:
+        return address, None
+    info, stale_for = entry
+    if stale_for > 0:
+        refresh_in_background(key, str(address))
+    return address, dict(info, ip=str(address))
+
+
+def _lookup_upstream(address, priority=ratelimit.INTERACTIVE, deadline=None):
+    # One caller per network at a time reads the on-disk cache and then upstream; callers joining an in-flight
+    # lookup still give up when their own deadline runs out
+    ip = str(address)
+    key = cache_key(address)
+    try:
+        info = flights.do(key, _load, key, ip, priority, deadline, timeout=deadline.remaining() if deadline else None)
+    except TimeoutError:
+        raise deadline.exceeded() from None
+    return dict(info, ip=ip)
+
+
+def _lookup_upstream_or_error(address, deadline=None):
+    # Bulk callers report a failed upstream call against its own address instead of failing the batch
+    try:
+        return _lookup_upstream(address, ratelimit.BULK, deadline)
+    except Exception as e:
+        return {'ip': str(address), 'error': True, 'reason': f"Error occurred: {e}"}
+
+
+def lookup(ip, deadline=None):
+    address, info = _answer_locally(ip)
+    return info if info is not None else _lookup_upstream(address, deadline=deadline)
+
+
+def lookup_many(ips, deadline=None):
+    # One result per input address, in input order, so callers can zip them with what they sent. Each distinct
+    # address is geolocated once: local answers and cache hits inline, the rest fanned out over the bulk pool.
+    # A failed or timed-out upstream call only fails its own address
+    answers = []
+    pending = {}
+    for ip in ips:
+        address, info = _answer_locally(ip)
+        if info is None:
+            pending.setdefault(str(address), address)
+            answers.append(str(address))
+        else:
+            answers.append(info)
+    futures = {ip: bulk_pool.submit(_lookup_upstream_or_error, address, deadline) for ip, address in pending.items()}
+    results = {}
+    for ip, future in futures.items():
+        try:
+            results[ip] = future.result(deadline.remaining() if deadline else None)
+        except TimeoutError:
+            results[ip] = {'ip': ip, 'error': True, 'reason': f"Error occurred: {deadline.exceeded()}"}
+    return [results[answer] if isinstance(answer, str) else answer for answer in answers]
+
+
+def _submit(ip, pool, timeout):
+    address, info = _answer_locally(ip)
+    if info is None:
+        return pool.submit(_lookup_upstream_or_error, address, upstream.Deadline(timeout) if timeout else None)
+    future = Future()
+    future.set_result(info)
+    return future
+
+
+def lookup_stream(ips, ordered=True, window=STREAM_LOOKUP_WINDOW, pool=None, timeout=None):
+    # Yields one result per input address while at most `window` lookups are outstanding; the input iterator is
+    # only advanced as results are consumed, so memory stays bounded however long it is. Ordered mode yields in
+    # input order, unordered mode as soon as each lookup completes. Upstream lookups run on `pool`, the shared
+    # bulk pool by default, each within `timeout` seconds of being submitted
+    pool = pool or bulk_pool
+    if ordered:
+        queue = deque()
+        for ip in ips:
+            queue.append(_submit(ip, pool, timeout))
+            while queue and (queue[0].done() or len(queue) >= window):
+                yield queue.popleft().result()
+        while queue:
+            yield queue.popleft().result()
+        return
+    pending = set()
+    for ip in ips:
+        future = _submit(ip, pool, timeout)
+        if future.done():
+            yield future.result()
+            continue
+        pending.add(future)
+        if len(pending) >= window:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield future.result()
+
+
+def compact(info):
+    return {field: info[field] for field in COMPACT_FIELDS if field in info}
+
+
+def _load(key, ip, priority, deadline=None):
+    # The caller missed the memory cache, but a flight for this key may have filled it since
+    cached = cache.get_entry(key, max_stale=GEO_CACHE_STALE_WHILE_REVALIDATE)
+    if cached is not None:
+        if cached[1] > 0:
+            refresh_in_background(key, ip)
+        return cached[0]
+    entry = disk_cache.get(key, max_stale=GEO_CACHE_STALE_IF_ERROR) if disk_cache else None
+    if entry is not None and entry[1] > -GEO_CACHE_STALE_WHILE_REVALIDATE:
+        info, remaining = entry
+        cache.set(key, info, ttl=remaining)
+        if remaining <= 0:
+            refresh_in_background(key, ip)
+        return info
+    try:
+        info = fetch(ip, priority, deadline)
+    except Exception:
+        # Stale-if-error: an upstream outage degrades to slightly old data when we have any
+        stale = cache.get_entry(key, max_stale=GEO_CACHE_STALE_IF_ERROR) or entry
+        if stale is None:
+            raise
+        return stale[0]
+    _store(key, info)
+    return info
+
+
+def _store(key, info):
+    # Upstream error payloads (bad input, rate limits) are never cached
+    if 'error' not in info:
+        cache.set(key, info)
+        if disk_cache:
+            disk_cache.set(key, info)
+
+
+def refresh_in_background(key, ip):
+    with _refreshing_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+    refresh_pool.submit(_refresh, key, ip)
+
+
+def _refresh(key, ip):
+    try:
+        _store(key, fetch(ip, ratelimit.BULK))
+    except Exception:
+        # The stale entry keeps being served (and retried) until it ages out of the stale-if-error window
+        pass
+    finally:
+        with _refreshing_lock:
+            _refreshing.discard(key)
+
+
+def cache_stats():
+    return {'memory': cache.stats(), 'disk': disk_cache.stats() if disk_cache else None, 'flights': flights.stats(),
+            'providers': router.stats()}
@@ -1,261 +1,239 @@
-from flask import Flask, render_template_string, jsonify, request
-import requests
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from flask import Flask, Response, abort, redirect, render_template, jsonify, request, stream_with_context, url_for
+from jinja2 import FileSystemBytecodeCache
 import speedtest
 
-app = Flask(__name__)
-
-# HTML template with IP info, a button to trigger speed test, input form for custom IP, and a button to show own IP info
-html_template = """
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>IP Info with Speed Test</title>
-    <link rel="stylesheet" href="https://unpkg.com/leaflet@1.7.1/dist/leaflet.css" />
-    <link href="https://fonts.googleapis.com/css2?family=Montserrat:wght@400&display=swap" rel="stylesheet">
-    <style>
-        body {
-            font-family: 'Montserrat', sans-serif;
-            font-size: 15px;
-            background-color: #f8f9fa;
-            color: #343a40;
-            padding: 20px;
-            margin: 0;
-        }
-        h1 {
-            font-size: 30px;
-            color: #009113;
-            text-align: center;
-            margin-bottom: 20px;
-        }
-        .container {
-            max-width: 800px;
-            margin: auto;
-            padding: 20px;
-            background-color: #ffffff;
-            border-radius: 8px;
-            box-shadow: 0 2px 10px rgba(0, 0, 0, 0.1);
-        }
-        .info {
-            background-color: #e9ecef;
-            padding: 15px;
-            border-radius: 8px;
-            margin-bottom: 20px;
-            display: flex;
-            justify-content: space-between;
-        }
-        .info div {
-            flex: 1;
-            margin: 0 10px;
-        }
-        .info h2 {
-            color: #495057;
-        }
-        .info p {
-            margin: 5px 0;
-        }
-        .error {
-            color: #dc3545;
-        }
-        #map {
-            height: 400px;
-            width: 100%;
-            border-radius: 8px;
-            margin-top: 20px;
-        }
-        footer {
-            text-align: center;
-            margin-top: 20px;
-            font-size: 0.9em;
-            color: #6c757d;
-        }
-        .speedtest-section {
-            margin-top: 20px;
-        }
-        button {
-            background-color: #009113;
-            color: white;
-            border: none;
-            padding: 10px 15px;
-            border-radius: 5px;
-            cursor: pointer;
-            font-size: 15px;
-        }
-        button:hover {
-            background-color: #007c0d;
-        }
-        form {
-            margin-bottom: 20px;
-        }
-        input[type="text"] {
-            padding: 10px;
-            width: 70%;
-            font-size: 15px;
-            border-radius: 5px;
-            border: 1px solid #ccc;
-        }
-        input[type="submit"] {
-            padding: 10px 15px;
-            font-size: 15px;
-            background-color: #009113;
-            color: white;
-            border: none;
-            border-radius: 5px;
-            cursor: pointer;
-        }
-        .return-button {
-            margin-top: 20px;
-            background-color: #007bff;
-            color: white;
-            border: none;
-            padding: 10px 15px;
-            border-radius: 5px;
-            cursor: pointer;
-            text-align: center;
-            font-size: 15px;
-        }
-        .return-button:hover {
-            background-color: #0056b3;
-        }
-    </style>
-</head>
-<body>
-    <div class="container">
-        <h1>Public IP Information</h1>
-        <form action="/get_ip_info" method="POST">
-            <input type="text" name="input_ip" placeholder="Enter an IPv4 or IPv6 address">
-            <input type="submit" value="Get IP Info">
-        </form>
-
-        <button class="return-button" onclick="window.location.href='/'">Show My IP Info</button>
-
-        <div class="info">
-            <div>
-                {% if ipv4_error %}
-                    <p class="error">{{ ipv4_error }}</p>
-                {% else %}
-                    <h2>IPv4 Information</h2>
-                    <p><strong>IP Address:</strong> {{ ipv4_info.get('ip') }}</p>
-                    <p><strong>City:</strong> {{ ipv4_info.get('city') }}</p>
-                    <p><strong>Region:</strong> {{ ipv4_info.get('region') }}</p>
-                    <p><strong>Country:</strong> {{ ipv4_info.get('country_name') }}</p>
-                    <p><strong>Latitude:</strong> {{ ipv4_info.get('latitude') }}</p>
-                    <p><strong>Longitude:</strong> {{ ipv4_info.get('longitude') }}</p>
-                    <p><strong>ISP:</strong> {{ ipv4_info.get('org') }}</p>
-                    <p><strong>ASN:</strong> {{ ipv4_info.get('asn') }}</p>
-                {% endif %}
-            </div>
-
-            <div>
-                {% if ipv6_error %}
-                    <p class="error">{{ ipv6_error }}</p>
-                {% else %}
-                    <h2>IPv6 Information</h2>
-                    <p><strong>IP Address:</strong> {{ ipv6_info.get('ip') }}</p>
-                    <p><strong>City:</strong> {{ ipv6_info.get('city') }}</p>
-                    <p><strong>Region:</strong> {{ ipv6_info.get('region') }}</p>
-                    <p><strong>Country:</strong> {{ ipv6_info.get('country_name') }}</p>
-                    <p><strong>Latitude:</strong> {{ ipv6_info.get('latitude') }}</p>
-                    <p><strong>Longitude:</strong> {{ ipv6_info.get('longitude') }}</p>
-                    <p><strong>ISP:</strong> {{ ipv6_info.get('org') }}</p>
-                    <p><strong>ASN:</strong> {{ ipv6_info.get('asn') }}</p>
-                {% endif %}
-            </div>
-        </div>
-
-        <div class="speedtest-section">
-            <h2>Internet Speed Test</h2>
-            <button onclick="runSpeedTest()">Run Speed Test</button>
-            <p id="speed-result"></p>
-        </div>
-
-        <div id="map"></div>
-    </div>
-
-    <footer>
-        <p>4ITF Group 1 System Integration and Architecture</p>
-    </footer>
-
-    <script src="https://unpkg.com/leaflet@1.7.1/dist/leaflet.js"></script>
-    <script>
-        var latitude = {{ ipv4_info.get('latitude') or ipv6_info.get('latitude') or 0 }};
-        var longitude = {{ ipv4_info.get('longitude') or ipv6_info.get('longitude') or 0 }};
-
-        var map = L.map('map').setView([latitude, longitude], 13);
-
-        L.tileLayer('https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png', {
-            maxZoom: 18,
-            attribution: 'OpenStreetMap'
-        }).addTo(map);
-
-        {% if ipv4_info %}
-        L.marker([{{ ipv4_info.get('latitude') }}, {{ ipv4_info.get('longitude') }}]).addTo(map)
-            .bindPopup("<b>IPv4 Location:</b><br>{{ ipv4_info.get('city') }}, {{ ipv4_info.get('region') }}.")
-            .openPopup();
-        {% endif %}
-
-        {% if ipv6_info %}
-        L.marker([{{ ipv6_info.get('latitude') }}, {{ ipv6_info.get('longitude') }}]).addTo(map)
-            .bindPopup("<b>IPv6 Location:</b><br>{{ ipv6_info.get('city') }}, {{ ipv6_info.get('region') }}.")
-            .openPopup();
-        {% endif %}
-
-        function runSpeedTest() {
-            document.getElementById("speed-result").textContent = "Running speed test...";
-            fetch('/run_speedtest')
-                .then(response => response.json())
-                .then(data => {
-                    if (data.error) {
-                        document.getElementById("speed-result").textContent = "Error: " + data.error;
-                    } else {
-                        document.getElementById("speed-result").textContent = 
-                            "Download Speed: " + data.download_speed + " Mbps, " +
-                            "Upload Speed: " + data.upload_speed + " Mbps";
-                    }
-                });
-        }
-    </script>
-</body>
-</html>
-"""
+import addresses
+import assets
+import compression
+import geolocation
+import public_ip
+import tiles
+import upstream
+
+app = Flask(__name__, static_folder=None)
+# HTML and JSON responses are gzip/brotli-encoded when the client accepts it
+app.after_request(compression.compress_response)
+
+# Page templates live in templates/ and are compiled once per process by the Jinja loader. Optionally the compiled
+# bytecode is also kept in TEMPLATE_BYTECODE_CACHE (a directory) so new workers skip compilation, and with
+# PRECOMPILE_TEMPLATES=1 every template is compiled at startup instead of on the first request
+TEMPLATE_BYTECODE_CACHE = os.environ.get('TEMPLATE_BYTECODE_CACHE', '')
+PRECOMPILE_TEMPLATES = os.environ.get('PRECOMPILE_TEMPLATES', '0') == '1'
+if TEMPLATE_BYTECODE_CACHE:
+    os.makedirs(TEMPLATE_BYTECODE_CACHE, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(TEMPLATE_BYTECODE_CACHE)
+app.jinja_env.globals['asset_url'] = lambda name: url_for('asset', filename=assets.manifest.fingerprinted(name))
+if PRECOMPILE_TEMPLATES:
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+# Most addresses accepted by one POST /api/lookup request
+BULK_LOOKUP_MAX = int(os.environ.get('BULK_LOOKUP_MAX', '1000'))
+# Seconds browsers and shared caches may reuse the page shell, and a GET /api/ip/<ip> answer
+SHELL_MAX_AGE = int(os.environ.get('SHELL_MAX_AGE', '300'))
+API_IP_MAX_AGE = int(os.environ.get('API_IP_MAX_AGE', '300'))
+# The page (through /api/me) shows the visitor's own address; set to 'server' to show this host's public addresses (found through ipify)
+IP_INFO_MODE = os.environ.get('IP_INFO_MODE', 'visitor')
+# Comma-separated proxies / networks whose X-Forwarded-For and Forwarded headers are believed
+TRUSTED_PROXIES = addresses.parse_networks(os.environ.get('TRUSTED_PROXIES', ''))
+# The forwarding header those proxies set: 'x-forwarded-for' (nginx, most load balancers) or 'forwarded' (RFC 7239).
+# Only that header is read; the other one is passed through from the client untouched and cannot be trusted
+TRUSTED_PROXY_HEADER = os.environ.get('TRUSTED_PROXY_HEADER', 'x-forwarded-for').strip().lower()
+if TRUSTED_PROXY_HEADER not in addresses.PROXY_HEADERS:
+    raise ValueError(f"TRUSTED_PROXY_HEADER must be one of {', '.join(addresses.PROXY_HEADERS)}")
+# Seconds each route may spend on upstream lookups before answering with whatever it has; the streaming
+# endpoint's budget applies to each address
+ROUTE_DEADLINES = {
+    'api_me': float(os.environ.get('DEADLINE_API_ME', '4')),
+    'api_ip': float(os.environ.get('DEADLINE_API_IP', '6')),
+    'api_lookup': float(os.environ.get('DEADLINE_API_LOOKUP', '30')),
+    'api_lookup_stream': float(os.environ.get('DEADLINE_API_LOOKUP_STREAM', '10')),
+}
+
+# Bounded pool that runs the independent IPv4 and IPv6 lookup chains side by side
+lookup_pool = ThreadPoolExecutor(max_workers=upstream.UPSTREAM_POOL_SIZE)
+# Discover this host's public addresses at startup rather than on the first page load
+if IP_INFO_MODE == 'server':
+    public_ip.monitor.start()
+# The rendered page shell; built on the first request, since asset URLs are resolved in a request context
+_shell = None
+
+
+def request_deadline():
+    return upstream.Deadline(ROUTE_DEADLINES[request.endpoint])
+
+
+def lookup_own_ip(family, deadline):
+    # Geolocate this host's public address for one family (kept fresh in the background); errors stay within the family
+    address, error = public_ip.monitor.address(family, deadline.remaining())
+    if address is None:
+        return None, error
+    try:
+        info = geolocation.lookup(address, deadline)
+        return info, None if info else f"Failed to retrieve {family} information"
+    except upstream.DeadlineExceeded:
+        return None, f"{family} lookup timed out"
+    except Exception as e:
+        return None, f"Error occurred: {e}"
 
-@app.route('/')
-def get_ip_info():
-    ipv4_url = 'https://api.ipify.org?format=json'
-    ipv6_url = 'https://api64.ipify.org?format=json'
 
+def lookup_visitor_ip(deadline):
+    # Geolocate the address this request came from; it fills the panel of its own family only
+    ip = addresses.client_address(request.remote_addr, TRUSTED_PROXY_HEADER,
+                                  request.headers.get(TRUSTED_PROXY_HEADER), TRUSTED_PROXIES)
     try:
-        # Get IPv4 and IPv6 information
-        ipv4_response = requests.get(ipv4_url)
-        ipv4_address = ipv4_response.json().get('ip') if ipv4_response.status_code == 200 else None
-        ipv4_info = requests.get(f'https://ipapi.co/{ipv4_address}/json/').json() if ipv4_address else None
-        ipv4_error = None if ipv4_info else "Failed to retrieve IPv4 information"
+        family = 'IPv%d' % addresses.parse(ip).version
+    except ValueError:
+        family = 'IPv4'
+    try:
+        info = geolocation.lookup(ip, deadline)
+        result = (None, info['reason']) if 'error' in info else (info, None)
+    except upstream.DeadlineExceeded:
+        result = (None, f"{family} lookup timed out")
+    except Exception as e:
+        result = (None, f"Error occurred: {e}")
+    other = 'IPv6' if family == 'IPv4' else 'IPv4'
+    results = {family: result, other: (None, f"This visit did not come over {other}")}
+    return results['IPv4'] + results['IPv6']
+
+
+def lookup_panels(deadline):
+    # (ipv4_info, ipv4_error, ipv6_info, ipv6_error) for the address(es) the page describes by default
+    if IP_INFO_MODE == 'server':
+        # Get IPv4 and IPv6 information concurrently; a family still running when the budget is spent is
+        # reported as timed out and the other one is shown regardless
+        ipv4_future = lookup_pool.submit(lookup_own_ip, 'IPv4', deadline)
+        ipv6_future = lookup_pool.submit(lookup_own_ip, 'IPv6', deadline)
+        try:
+            ipv4_info, ipv4_error = ipv4_future.result(deadline.remaining())
+        except TimeoutError:
+            ipv4_info, ipv4_error = None, "IPv4 lookup timed out"
+        try:
+            ipv6_info, ipv6_error = ipv6_future.result(deadline.remaining())
+        except TimeoutError:
+            ipv6_info, ipv6_error = None, "IPv6 lookup timed out"
+        return ipv4_info, ipv4_error, ipv6_info, ipv6_error
+    return lookup_visitor_ip(deadline)
+
+
+def panel(info, error):
+    return geolocation.compact(info) if info else {'error': True, 'reason': error}
 
-        ipv6_response = requests.get(ipv6_url)
-        ipv6_address = ipv6_response.json().get('ip') if ipv6_response.status_code == 200 else None
-        ipv6_info = requests.get(f'https://ipapi.co/{ipv6_address}/json/').json() if ipv6_address else None
-        ipv6_error = None if ipv6_info else "Failed to retrieve IPv6 information"
 
-        return render_template_string(html_template, ipv4_info=ipv4_info, ipv4_error=ipv4_error,
-                                      ipv6_info=ipv6_info, ipv6_error=ipv6_error)
+@app.route('/')
+def index():
+    # The page is the same for everyone; app.js fills in the panels and markers from the JSON API, so it is
+    # rendered once per process and may be cached by browsers and shared caches
+    global _shell
+    if _shell is None:
+        _shell = render_template('index.html')
+    response = Response(_shell, mimetype='text/html')
+    response.cache_control.public = True
+    response.cache_control.max_age = SHELL_MAX_AGE
+    response.add_etag()
+    return response.make_conditional(request)
 
-    except Exception as e:
-        return render_template_string(html_template, ipv4_info=None, ipv4_error=f"Error occurred: {e}",
-                                      ipv6_info=None, ipv6_error=f"Error occurred: {e}")
 
 
 @app.route('/get_ip_info', methods=['POST'])
 def get_custom_ip_info():
-    input_ip = request.form.get('input_ip')
+    # Keeps plain form posts (bookmarks, scripts, the form before app.js has loaded) working: the page looks up
+    # ?ip= itself. Without JavaScript the page can only say that it needs it
+    return redirect(url_for('index', ip=request.form.get('input_ip', '')), 303)
+
+
+@app.route('/api/me')
+def api_me():
+    ipv4_info, ipv4_error, ipv6_info, ipv6_error = lookup_panels(request_deadline())
+    response = jsonify(ipv4=panel(ipv4_info, ipv4_error), ipv6=panel(ipv6_info, ipv6_error))
+    # Depends on who is asking (visitor mode), so only the browser itself may reuse it
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route('/api/ip/<ip>')
+def api_ip(ip):
     try:
-        ip_info = requests.get(f'https://ipapi.co/{input_ip}/json/').json()
-        if 'error' in ip_info:
-            return render_template_string(html_template, ipv4_info=None, ipv6_info=None, ipv4_error=ip_info['reason'], ipv6_error=ip_info['reason'])
-        else:
-            return render_template_string(html_template, ipv4_info=ip_info, ipv6_info=ip_info)
+        info = geolocation.lookup(ip, request_deadline())
+    except upstream.DeadlineExceeded:
+        return jsonify(ip=ip, error=True, reason="Lookup timed out"), 504
     except Exception as e:
-        return render_template_string(html_template, ipv4_info=None, ipv6_info=None, ipv4_error=f"Error occurred: {e}", ipv6_error=f"Error occurred: {e}")
+        return jsonify(ip=ip, error=True, reason=f"Error occurred: {e}"), 502
+    if 'error' in info:
+        return jsonify(geolocation.compact(info)), 400
+    response = jsonify(geolocation.compact(info))
+    response.cache_control.public = True
+    response.cache_control.max_age = API_IP_MAX_AGE
+    return response
+
+
+@app.route('/api/lookup', methods=['POST'])
+def api_lookup():
+    # Body is a JSON array of addresses; answers an array of compact objects, one per input address in the same order
+    ips = request.get_json(silent=True)
+    if not isinstance(ips, list) or not all(isinstance(ip, str) for ip in ips):
+        return jsonify(error="Expected a JSON array of IP address strings"), 400
+    if len(ips) > BULK_LOOKUP_MAX:
+        return jsonify(error=f"At most {BULK_LOOKUP_MAX} addresses per request"), 413
+    return jsonify([geolocation.compact(info) for info in geolocation.lookup_many(ips, request_deadline())])
+
+
+@app.route('/api/lookup/stream', methods=['POST'])
+def api_lookup_stream():
+    # Body is newline-delimited addresses, read incrementally; answers NDJSON as results become available,
+    # in input order unless ?ordered=0
+    ordered = request.args.get('ordered', '1') != '0'
+    lines = (line.decode('utf-8', 'replace').strip() for line in request.stream)
+    results = geolocation.lookup_stream((line for line in lines if line), ordered=ordered,
+                                        timeout=ROUTE_DEADLINES['api_lookup_stream'])
+    return Response(stream_with_context(json.dumps(geolocation.compact(info)) + '\n' for info in results),
+                    mimetype='application/x-ndjson')
+
+
+@app.route('/assets/<path:filename>')
+def asset(filename):
+    # Fingerprinted static files: the name changes whenever the content does, so they are cached for a year and
+    # served precompressed in the best coding the client accepts
+    item = assets.manifest.find(filename)
+    if item is None:
+        abort(404)
+    coding = request.accept_encodings.best_match([c for c in ('br', 'gzip') if c in item.variants]) or 'identity'
+    response = Response(item.variants[coding], mimetype=item.mimetype)
+    if coding != 'identity':
+        response.content_encoding = coding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.max_age = 31536000
+    response.cache_control.immutable = True
+    response.set_etag(item.etag(coding))
+    return response.make_conditional(request)
+
+
+@app.route('/tiles/<int:z>/<int:x>/<int:y>.png')
+def map_tile(z, x, y):
+    # Map tiles through the on-disk tile cache; browsers may keep them as long as the cache considers them fresh
+    try:
+        data, info = tiles.tile(z, x, y)
+    except ValueError:
+        abort(404)
+    except tiles.TileError as e:
+        return Response(str(e), status=502, mimetype='text/plain')
+    response = Response(data, mimetype='image/png')
+    response.cache_control.public = True
+    response.cache_control.max_age = max(0, int(info['expires'] - time.time()))
+    response.set_etag(info['digest'])
+    return response.make_conditional(request)
+
+
+@app.route('/cache_stats')
+def cache_stats():
+    return jsonify(dict(geolocation.cache_stats(), public_ip=public_ip.monitor.stats(), tiles=tiles.stats()))
 
 
 @app.route('/run_speedtest')
@@ -0,0 +1,366 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait as wait_futures
+
+import ratelimit
+import upstream
+
+DAY = 86400
+MONTH = 30 * DAY
+
+# How quickly the latency / error averages follow new observations
+EWMA_ALPHA = 0.2
+# Successful request latencies kept per provider for the hedging percentile, and how many are needed before
+# hedging trusts it
+LATENCY_SAMPLES = 200
+HEDGE_MIN_SAMPLES = 20
+
+
+class ProviderError(Exception):
+    pass
+
+
+class Provider:
+    # One geolocation API. Subclasses build the request URL and map the reply into the ipapi.co field names the
+    # template reads; each provider keeps its own request budget. The class defaults for `rate` (requests per
+    # second) and `burst` keep a bucket within the provider's documented free-tier quota: over any window W it
+    # admits at most burst + rate * W requests
+
+    name = None
+    base_url = None
+    rate = None
+    burst = None
+
+    def __init__(self, base_url=None, token=None, rate=None, burst=None, max_waiting=256, rate_state=None,
+                 default_backoff=60):
+        self.base_url = (base_url or self.base_url).rstrip('/')
+        self.token = token
+        self.default_backoff = default_backoff
+        self.rate = self.rate if rate is None else rate
+        self.burst = self.burst if burst is None else burst
+        self.bucket = ratelimit.TokenBucket(
+            self.rate, self.burst, max_waiting,
+            ratelimit.SQLiteBucketState(rate_state, self.name) if rate_state else None)
+
+    def url(self, ip):
+        raise NotImplementedError
+
+    def parse(self, payload, ip):
+        raise NotImplementedError
+
+    def fetch(self, ip, priority=ratelimit.INTERACTIVE, wait=None, deadline=None, budget=None):
+        # Raises RateLimited when no request slot comes within `wait` seconds, ProviderError when the provider
+        # itself is failing or throttling us; an answer about the address (even an error one) is returned.
+        # The call is bounded by `deadline`, and by `budget` seconds of it when given
+        if deadline is not None:
+            wait = deadline.remaining() if wait is None else min(wait, deadline.remaining())
+        self.bucket.acquire(priority, timeout=wait)
+        response = upstream.get(self.url(ip), deadline=deadline, budget=budget)
+        if response.status_code == 429:
+            self._back_off(response)
+            raise ProviderError(f"{self.name} rate limited")
+        if response.status_code >= 500:
+            raise ProviderError(f"{self.name} returned HTTP {response.status_code}")
+        info = self.parse(response.json(), ip)
+        if info.get('reason') == 'RateLimited':
+            self._back_off(response)
+            raise ProviderError(f"{self.name} rate limited")
+        return info
+
+    def _back_off(self, response):
+        self.bucket.pause(ratelimit.retry_after_seconds(response.headers.get('Retry-After'), self.default_backoff))
+
+
+def _error(ip, reason):
+    return {'ip': ip, 'error': True, 'reason': reason}
+
+
+def _split_as(value):
+    # "AS15169 Google LLC" -> ("AS15169", "Google LLC")
+    first, _, rest = (value or '').partition(' ')
+    return (first, rest) if first.startswith('AS') else (None, value)
+
+
+class IpapiProvider(Provider):
+    # https://ipapi.co, whose field names the rest of the app uses
+    name = 'ipapi'
+    base_url = 'https://ipapi.co'
+    # Free tier: 1,000 requests a day
+    burst = 10
+    rate = (1000 - burst) / DAY
+
+    def url(self, ip):
+        return f'{self.base_url}/{ip}/json/' + (f'?key={self.token}' if self.token else '')
+
+    def parse(self, payload, ip):
+        return payload
+
+
+class IpwhoisProvider(Provider):
+    # https://ipwho.is
+    name = 'ipwhois'
+    base_url = 'https://ipwho.is'
+    # Free tier: 10,000 requests a month
+    burst = 10
+    rate = (10000 - burst) / MONTH
+
+    def url(self, ip):
+        return f'{self.base_url}/{ip}'
+
+    def parse(self, payload, ip):
+        if not payload.get('success', True):
+            message = payload.get('message', 'Lookup failed')
+            return _error(ip, 'RateLimited' if 'limit' in message.lower() else message)
+        connection = payload.get('connection') or {}
+        asn = connection.get('asn')
+        return {'ip': payload.get('ip', ip), 'city': payload.get('city'), 'region': payload.get('region'),
+                'country_name': payload.get('country'), 'latitude': payload.get('latitude'),
+                'longitude': payload.get('longitude'), 'org': connection.get('org') or connection.get('isp'),
+                'asn': f'AS{asn}' if asn else None}
+
+
+class IpApiComProvider(Provider):
+    # http://ip-api.com (the free tier is plain HTTP only)
+    name = 'ipapi_com'
+    base_url = 'http://ip-api.com'
+    # Free tier: 45 requests a minute
+    burst = 9
+    rate = (45 - burst) / 60
+
+    def url(self, ip):
+        return f'{self.base_url}/json/{ip}?fields=status,message,query,city,regionName,country,lat,lon,isp,org,as'
+
+    def parse(self, payload, ip):
+        if payload.get('status') != 'success':
+            return _error(ip, payload.get('message', 'Lookup failed'))
+        asn, as_name = _split_as(payload.get('as'))
+        return {'ip': payload.get('query', ip), 'city': payload.get('city'), 'region': payload.get('regionName'),
+                'country_name': payload.get('country'), 'latitude': payload.get('lat'),
+                'longitude': payload.get('lon'), 'org': payload.get('org') or payload.get('isp') or as_name,
+                'asn': asn}
+
+
+class IpinfoProvider(Provider):
+    # https://ipinfo.io, which only reports country codes
+    name = 'ipinfo'
+    base_url = 'https://ipinfo.io'
+    # Free tier: 50,000 requests a month
+    burst = 10
+    rate = (50000 - burst) / MONTH
+
+    def url(self, ip):
+        return f'{self.base_url}/{ip}/json' + (f'?token={self.token}' if self.token else '')
+
+    def parse(self, payload, ip):
+        if 'error' in payload:
+            error = payload['error']
+            return _error(ip, error.get('message', 'Lookup failed') if isinstance(error, dict) else str(error))
+        if payload.get('bogon'):
+            return dict(_error(ip, 'Reserved IP Address'), reserved=True)
+        latitude, _, longitude = (payload.get('loc') or ',').partition(',')
+        asn, org = _split_as(payload.get('org'))
+        return {'ip': payload.get('ip', ip), 'city': payload.get('city'), 'region': payload.get('region'),
+                'country_name': payload.get('country'), 'latitude': float(latitude) if latitude else None,
+                'longitude': float(longitude) if longitude else None, 'org': org, 'asn': asn}
+
+
+PROVIDERS = {cls.name: cls for cls in (IpapiProvider, IpwhoisProvider, IpApiComProvider, IpinfoProvider)}
+
+
+def from_env(name, rate_state=None):
+    # Each provider is configured through <NAME>_URL, <NAME>_TOKEN, <NAME>_RATE, <NAME>_BURST (to raise the
+    # free-tier defaults on a paid plan), <NAME>_MAX_WAITING, <NAME>_RATE_STATE and <NAME>_BACKOFF.
+    # <NAME>_RATE_STATE (default: `rate_state`) is the SQLite file that shares its budget between the worker
+    # processes on the host; without one each process spends the whole budget on its own
+    prefix = name.upper() + '_'
+    env = lambda key, default=None: os.environ.get(prefix + key, default)
+    number = lambda key: float(env(key)) if env(key) else None
+    return PROVIDERS[name](
+        base_url=env('URL'), token=env('TOKEN'), rate=number('RATE'), burst=number('BURST'),
+        max_waiting=int(env('MAX_WAITING', '256')), rate_state=env('RATE_STATE', rate_state) or None,
+        default_backoff=float(env('BACKOFF', '60')))
+
+
+class ProviderHealth:
+    # Latency / error averages and circuit-breaker state for one provider; guarded by the router's lock
+
+    def __init__(self):
+        self.latency = None
+        self.error_rate = 0.0
+        self.consecutive_failures = 0
+        self.open_until = 0
+        self.probing = False
+        self.requests = 0
+        self.failures = 0
+        self.samples = deque(maxlen=LATENCY_SAMPLES)
+
+    def percentile(self, fraction):
+        if len(self.samples) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[int(fraction * (len(ordered) - 1))]
+
+
+class Router:
+    # Sends each lookup to the fastest healthy provider and fails over down the list. A provider that fails
+    # `failure_threshold` times in a row is taken out of rotation for `cooldown` seconds, then gets a single probe
+    # request that either closes the circuit again or re-opens it.
+    # With hedging on, a lookup still unanswered after the first provider's p95 latency is duplicated to the next
+    # provider (or the same one when it is the only one) and the first answer wins; at most `hedge_ratio` of
+    # lookups are hedged so upstream load cannot double. A lookup that may be hedged runs its primary on a pool of
+    # `primary_workers` threads (sized to the callers' concurrency) while the caller waits for the first answer;
+    # backups run on a separate pool of `hedge_workers`. Lookups that cannot be hedged, or find every primary
+    # worker busy, run on the caller's thread, so neither pool ever queues
+
+    def __init__(self, providers, failure_threshold=5, cooldown=30, hedge=False, hedge_ratio=0.05,
+                 hedge_workers=32, max_error_rate=0.5, primary_workers=32):
+        self.providers = providers
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_error_rate = max_error_rate
+        self.health = {provider.name: ProviderHealth() for provider in providers}
+        self._lock = threading.Lock()
+        self.hedge = hedge
+        self.hedge_ratio = hedge_ratio
+        self._hedge_pool = ThreadPoolExecutor(max_workers=hedge_workers) if hedge else None
+        self._primary_pool = ThreadPoolExecutor(max_workers=primary_workers) if hedge else None
+        self._primary_slots = threading.BoundedSemaphore(primary_workers)
+        self.lookups = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def candidates(self):
+        # At most one provider whose cooldown has passed, as a probe (the others back it up if it fails), then
+        # closed circuits ordered by _rank, untried providers first so they get measured
+        now = time.monotonic()
+        with self._lock:
+            closed = []
+            probe = None
+            for provider in self.providers:
+                health = self.health[provider.name]
+                if health.open_until == 0:
+                    closed.append(provider)
+                elif probe is None and health.open_until <= now and not health.probing:
+                    health.probing = True
+                    probe = provider
+            closed.sort(key=self._rank)
+        return ([probe] if probe else []) + closed
+
+    def _rank(self, provider):
+        # Providers failing more often than max_error_rate go after the healthy ones. Within each group the
+        # latency is scaled by the expected number of attempts, so a fast provider that often fails (but not
+        # often enough in a row to trip the breaker) loses to a slightly slower reliable one
+        health = self.health[provider.name]
+        return health.error_rate > self.max_error_rate, (health.latency or 0) / (1 - min(health.error_rate, 0.9))
+
+    def record(self, provider, latency, failed):
+        with self._lock:
+            health = self.health[provider.name]
+            health.requests += 1
+            health.error_rate += EWMA_ALPHA * ((1.0 if failed else 0.0) - health.error_rate)
+            health.probing = False
+            if failed:
+                health.failures += 1
+                health.consecutive_failures += 1
+                if health.open_until or health.consecutive_failures >= self.failure_threshold:
+                    health.open_until = time.monotonic() + self.cooldown
+                return
+            health.latency = latency if health.latency is None else health.latency + EWMA_ALPHA * (latency - health.latency)
+            health.samples.append(latency)
+            health.consecutive_failures = 0
+            health.open_until = 0
+
+    def fetch(self, ip, priority=ratelimit.INTERACTIVE, wait=None, deadline=None):
+        candidates = self.candidates()
+        if not candidates:
+            raise ProviderError("No geolocation provider is available")
+        with self._lock:
+            self.lookups += 1
+            delay = self.health[candidates[0].name].percentile(0.95) if self.hedge else None
+            hedgeable = delay is not None and self.hedges < self.hedge_ratio * self.lookups
+        # The caller must stay free to take whichever answer comes first, so a hedgeable primary runs on a primary
+        # worker; it only does so when one is idle, as time spent queueing would count towards the hedge delay
+        if not hedgeable or not self._primary_slots.acquire(blocking=False):
+            return self._fetch(candidates, ip, priority, wait, deadline)
+        primary = self._primary_pool.submit(self._fetch, candidates, ip, priority, wait, deadline)
+        primary.add_done_callback(lambda future: self._primary_slots.release())
+        done, _ = wait_futures([primary], timeout=delay)
+        if done or not self._take_hedge():
+            return primary.result()
+        # The backup only uses a provider with a free request slot right now; hedges never queue for the budget.
+        # A blocking HTTP call cannot be interrupted, so the loser is abandoned and its answer only updates health
+        backup = self._hedge_pool.submit(self._fetch, candidates[1:] + candidates[:1], ip, priority, 0, deadline)
+        pending = {primary, backup}
+        while True:
+            done, pending = wait_futures(pending, timeout=deadline.remaining() if deadline else None,
+                                         return_when=FIRST_COMPLETED)
+            if not done:
+                raise deadline.exceeded()
+            winner = next((future for future in done if future.exception() is None), None)
+            if winner is not None:
+                if winner is backup:
+                    with self._lock:
+                        self.hedge_wins += 1
+                return winner.result()
+            if not pending:
+                # Both failed; report the primary's error
+                return primary.result()
+
+    def _take_hedge(self):
+        with self._lock:
+            if self.hedges >= self.hedge_ratio * self.lookups:
+                return False
+            self.hedges += 1
+            return True
+
+    def _fetch(self, candidates, ip, priority, wait, deadline=None):
+        # Providers without a free request slot are skipped straight away; only the last candidate is waited for.
+        # Under a deadline each attempt gets an equal share of what is left, so a hung provider still leaves time
+        # to fail over
+        errors = []
+        for i, provider in enumerate(candidates):
+            last = i == len(candidates) - 1
+            start = time.monotonic()
+            budget = deadline.remaining() / (len(candidates) - i) if deadline else None
+            try:
+                info = provider.fetch(ip, priority, wait if last else 0, deadline, budget)
+            except upstream.DeadlineExceeded:
+                raise
+            except ratelimit.RateLimited as e:
+                errors.append(f"{provider.name}: {e}")
+                continue
+            except Exception as e:
+                if deadline is not None and deadline.expired():
+                    # Out of budget: the provider was not necessarily at fault, so its health is left alone
+                    raise deadline.exceeded() from e
+                self.record(provider, time.monotonic() - start, failed=True)
+                errors.append(f"{provider.name}: {e}")
+                continue
+            finally:
+                # A probe that ended without a verdict (rate limited, out of budget) must not keep the provider
+                # out of rotation; the next lookup after the cooldown probes it again
+                with self._lock:
+                    self.health[provider.name].probing = False
+            self.record(provider, time.monotonic() - start, failed=False)
+            return info
+        raise ProviderError("All geolocation providers failed (" + "; ".join(errors) + ")")
+
+    def stats(self):
+        stats = {}
+        with self._lock:
+            for provider in self.providers:
+                health = self.health[provider.name]
+                stats[provider.name] = {
+                    'latency': health.latency,
+                    'error_rate': round(health.error_rate, 3),
+                    'circuit': 'open' if health.open_until else 'closed',
+                    'requests': health.requests,
+                    'failures': health.failures,
+                    'p95_latency': health.percentile(0.95),
+                    'rate_limit': provider.bucket.stats(),
+                }
+            stats['hedging'] = {'enabled': self.hedge, 'lookups': self.lookups, 'hedges': self.hedges,
+                                'hedge_wins': self.hedge_wins}
+        return stats
@@ -0,0 +1,109 @@
+import os
+import socket
+import threading
+import time
+
+import upstream
+
+# Where this host's egress addresses are discovered; api64 answers over IPv6 when the host has it
+PUBLIC_IP_URLS = {
+    'IPv4': 'https://api.ipify.org?format=json',
+    'IPv6': 'https://api64.ipify.org?format=json',
+}
+# Seconds between background re-discoveries of the egress addresses
+PUBLIC_IP_REFRESH = float(os.environ.get('PUBLIC_IP_REFRESH', '300'))
+# Seconds between checks of the local source addresses; a change (new DHCP lease, VPN, failover) triggers an
+# immediate re-discovery. 0 disables the check
+PUBLIC_IP_WATCH_INTERVAL = float(os.environ.get('PUBLIC_IP_WATCH_INTERVAL', '10'))
+# How long a page load waits for the very first discovery after startup
+PUBLIC_IP_STARTUP_WAIT = float(os.environ.get('PUBLIC_IP_STARTUP_WAIT', '10'))
+
+# Routable addresses used only to pick the outbound interface; connecting a UDP socket sends no packets
+_PROBE_TARGETS = ((socket.AF_INET, '192.0.2.1'), (socket.AF_INET6, '2001:db8::1'))
+
+
+def local_addresses():
+    # The source address the kernel would use for outbound traffic, per family (None when there is no route)
+    addresses = []
+    for family, target in _PROBE_TARGETS:
+        try:
+            with socket.socket(family, socket.SOCK_DGRAM) as sock:
+                sock.connect((target, 53))
+                addresses.append(sock.getsockname()[0])
+        except OSError:
+            addresses.append(None)
+    return tuple(addresses)
+
+
+class PublicIPMonitor:
+    # Keeps this host's public IPv4/IPv6 addresses in memory, refreshed by a background thread, so page loads
+    # never call ipify themselves. A failed refresh keeps the last known address
+
+    def __init__(self, urls, refresh, watch_interval):
+        self.urls = urls
+        self.refresh_interval = refresh
+        self.watch_interval = watch_interval
+        self.addresses = {}
+        self.errors = {}
+        self.refreshed_at = None
+        self._lock = threading.Lock()
+        self._resolved = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='public-ip-monitor', daemon=True)
+                self._thread.start()
+
+    def refresh(self):
+        for family, url in self.urls.items():
+            try:
+                response = upstream.get(url)
+                address = response.json().get('ip') if response.status_code == 200 else None
+                error = None if address else f"Failed to retrieve {family} information"
+            except Exception as e:
+                address, error = None, f"Error occurred: {e}"
+            with self._lock:
+                if address:
+                    self.addresses[family] = address
+                self.errors[family] = error
+        with self._lock:
+            self.refreshed_at = time.time()
+        self._resolved.set()
+
+    def _run(self):
+        watched = local_addresses() if self.watch_interval else None
+        next_refresh = 0
+        while True:
+            if time.monotonic() >= next_refresh or self._wake.is_set():
+                self._wake.clear()
+                self.refresh()
+                next_refresh = time.monotonic() + self.refresh_interval
+            timeout = next_refresh - time.monotonic()
+            if self.watch_interval:
+                timeout = min(timeout, self.watch_interval)
+            self._wake.wait(max(timeout, 0))
+            if self.watch_interval:
+                current = local_addresses()
+                if current != watched:
+                    watched = current
+                    self._wake.set()
+
+    def address(self, family, timeout=PUBLIC_IP_STARTUP_WAIT):
+        # (address, error) for 'IPv4' or 'IPv6'; the error is only set when no address has ever been discovered
+        self.start()
+        self._resolved.wait(timeout)
+        with self._lock:
+            address = self.addresses.get(family)
+            if address:
+                return address, None
+            return None, self.errors.get(family) or f"Failed to retrieve {family} information"
+
+    def stats(self):
+        with self._lock:
+            return {'addresses': dict(self.addresses), 'errors': dict(self.errors), 'refreshed_at': self.refreshed_at}
+
+
+monitor = PublicIPMonitor(PUBLIC_IP_URLS, PUBLIC_IP_REFRESH, PUBLIC_IP_WATCH_INTERVAL)
@@ -0,0 +1,161 @@
+import heapq
+import itertools
+import sqlite3
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+# Waiter priorities; lower is served first
+INTERACTIVE = 0
+BULK = 1
+
+
+class RateLimited(Exception):
+    pass
+
+
+class LocalBucketState:
+    # Token count shared by the threads of this process only; always used under TokenBucket's lock
+
+    def __init__(self, burst):
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.paused_until = 0
+
+    def take(self, rate, burst):
+        # Takes a token and returns 0, or returns the seconds until one could be taken
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.tokens = min(burst, self.tokens + (now - self.updated_at) * rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / rate
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class SQLiteBucketState:
+    # Token count shared by every process on the host through one SQLite row per bucket
+
+    def __init__(self, path, name):
+        self.path = path
+        self.name = name
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS buckets ('
+                         'name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL, '
+                         'paused_until REAL NOT NULL)')
+            self._local.conn = conn
+        return conn
+
+    def _update(self, fn):
+        # Runs fn(tokens, updated_at, paused_until, now) -> (new state, result) in one write transaction
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            row = conn.execute('SELECT tokens, updated_at, paused_until FROM buckets WHERE name = ?',
+                               (self.name,)).fetchone()
+            state, result = fn(*(row or (None, now, 0)), now)
+            conn.execute('INSERT OR REPLACE INTO buckets (name, tokens, updated_at, paused_until) VALUES (?, ?, ?, ?)',
+                         (self.name, *state))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return result
+
+    def take(self, rate, burst):
+        def take(tokens, updated_at, paused_until, now):
+            if now < paused_until:
+                return (tokens, updated_at, paused_until), paused_until - now
+            tokens = burst if tokens is None else min(burst, tokens + (now - updated_at) * rate)
+            if tokens >= 1:
+                return (tokens - 1, now, paused_until), 0
+            return (tokens, now, paused_until), (1 - tokens) / rate
+        return self._update(take)
+
+    def pause(self, seconds):
+        def pause(tokens, updated_at, paused_until, now):
+            return (0 if tokens is None else tokens, updated_at, max(paused_until, now + seconds)), None
+        self._update(pause)
+
+
+class TokenBucket:
+    # Admits at most `rate` requests per second (bursts up to `burst`). Callers queue in priority order, the queue
+    # is bounded, and a caller that could not be admitted within its timeout fails fast with RateLimited
+
+    def __init__(self, rate, burst, max_waiting, state=None):
+        self.rate = rate
+        self.burst = burst
+        self.max_waiting = max_waiting
+        self.state = state or LocalBucketState(burst)
+        self._cond = threading.Condition()
+        self._waiters = []
+        self._seq = itertools.count()
+        self.granted = 0
+        self.rejected = 0
+        self.pauses = 0
+
+    def acquire(self, priority=INTERACTIVE, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            if len(self._waiters) >= self.max_waiting:
+                self.rejected += 1
+                raise RateLimited("Too many upstream requests queued")
+            waiter = (priority, next(self._seq))
+            heapq.heappush(self._waiters, waiter)
+            self._cond.notify_all()
+            try:
+                while True:
+                    # Only the head of the queue takes tokens; everyone else sleeps until the head changes
+                    wait = self.state.take(self.rate, self.burst) if self._waiters[0] == waiter else None
+                    if wait == 0:
+                        self.granted += 1
+                        return
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0 or (wait is not None and wait > remaining):
+                            self.rejected += 1
+                            raise RateLimited("Upstream rate limit reached, try again shortly")
+                        wait = remaining if wait is None else wait
+                    self._cond.wait(wait)
+            finally:
+                self._waiters.remove(waiter)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+
+    def pause(self, seconds):
+        # Upstream told us to back off (429 / Retry-After): nobody is admitted until it has passed
+        with self._cond:
+            self.state.pause(seconds)
+            self.pauses += 1
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {'rate': self.rate, 'burst': self.burst, 'waiting': len(self._waiters),
+                    'granted': self.granted, 'rejected': self.rejected, 'pauses': self.pauses}
+
+
+def retry_after_seconds(value, default):
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
@@ -0,0 +1,152 @@
+// IP info page: fetches /api/me or /api/ip/<ip> and fills in the panels and map markers without reloading
+
+var FIELDS = [
+    ["IP Address", "ip"], ["City", "city"], ["Region", "region"], ["Country", "country_name"],
+    ["Latitude", "latitude"], ["Longitude", "longitude"], ["ISP", "org"], ["ASN", "asn"]
+];
+
+var map, markers, api;
+
+function escapeHtml(value) {
+    var div = document.createElement("div");
+    div.textContent = value == null ? "" : String(value);
+    return div.innerHTML;
+}
+
+function renderPanel(family, info) {
+    var panel = document.getElementById(family.toLowerCase() + "-panel");
+    panel.replaceChildren();
+    if (info.error) {
+        var error = document.createElement("p");
+        error.className = "error";
+        error.textContent = info.reason;
+        panel.appendChild(error);
+        return;
+    }
+    var heading = document.createElement("h2");
+    heading.textContent = family + " Information";
+    panel.appendChild(heading);
+    FIELDS.forEach(function (field) {
+        var line = document.createElement("p");
+        var label = document.createElement("strong");
+        label.textContent = field[0] + ":";
+        line.appendChild(label);
+        line.appendChild(document.createTextNode(" " + (info[field[1]] == null ? "" : info[field[1]])));
+        panel.appendChild(line);
+    });
+}
+
+function addMarker(info, family) {
+    L.marker([info.latitude, info.longitude]).addTo(markers)
+        .bindPopup("<b>" + family + " Location:</b><br>" + escapeHtml(info.city) + ", " + escapeHtml(info.region) + ".")
+        .openPopup();
+}
+
+function showResults(ipv4Info, ipv6Info) {
+    renderPanel("IPv4", ipv4Info);
+    renderPanel("IPv6", ipv6Info);
+    markers.clearLayers();
+    var located = [[ipv4Info, "IPv4"], [ipv6Info, "IPv6"]].filter(function (entry) {
+        return !entry[0].error && entry[0].latitude != null && entry[0].longitude != null;
+    });
+    located.forEach(function (entry) {
+        addMarker(entry[0], entry[1]);
+    });
+    if (located.length) {
+        map.setView([located[0][0].latitude, located[0][0].longitude], 13);
+    }
+}
+
+function failure(error) {
+    return {error: true, reason: "Error occurred: " + error};
+}
+
+function lookup(path) {
+    document.getElementById("ipv4-panel").replaceChildren(document.createTextNode("Loading..."));
+    document.getElementById("ipv6-panel").replaceChildren();
+    return fetch(api + path, {headers: {"Accept": "application/json"}})
+        .then(response => response.json());
+}
+
+function lookupMine() {
+    lookup("me")
+        .then(data => showResults(data.ipv4, data.ipv6))
+        .catch(error => showResults(failure(error), failure(error)));
+}
+
+function lookupIp(ip) {
+    if (!ip) {
+        var invalid = {error: true, reason: "Invalid IP Address"};
+        showResults(invalid, invalid);
+        return;
+    }
+    lookup("ip/" + encodeURIComponent(ip))
+        .then(info => showResults(info, info))
+        .catch(error => showResults(failure(error), failure(error)));
+}
+
+function route() {
+    // ?ip=<address> looks that address up, otherwise the page describes the visitor (or the server)
+    var ip = new URLSearchParams(window.location.search).get("ip");
+    if (ip === null) {
+        lookupMine();
+    } else {
+        document.querySelector("#lookup-form input[name=input_ip]").value = ip;
+        lookupIp(ip.trim());
+    }
+}
+
+function initMap(element) {
+    // Marker images are fingerprinted assets, so Leaflet cannot derive their URLs from its stylesheet
+    L.Icon.Default.mergeOptions({
+        imagePath: "",
+        iconUrl: element.dataset.icon,
+        iconRetinaUrl: element.dataset.iconRetina,
+        shadowUrl: element.dataset.iconShadow
+    });
+
+    map = L.map("map").setView([0, 0], 2);
+
+    // Tiles come through our own caching proxy rather than straight from OpenStreetMap
+    L.tileLayer(element.dataset.tiles, {
+        maxZoom: 18,
+        attribution: "&copy; OpenStreetMap contributors"
+    }).addTo(map);
+
+    markers = L.layerGroup().addTo(map);
+}
+
+function runSpeedTest() {
+    document.getElementById("speed-result").textContent = "Running speed test...";
+    fetch("/run_speedtest")
+        .then(response => response.json())
+        .then(data => {
+            if (data.error) {
+                document.getElementById("speed-result").textContent = "Error: " + data.error;
+            } else {
+                document.getElementById("speed-result").textContent =
+                    "Download Speed: " + data.download_speed + " Mbps, " +
+                    "Upload Speed: " + data.upload_speed + " Mbps";
+            }
+        });
+}
+
+document.addEventListener("DOMContentLoaded", function () {
+    var element = document.getElementById("map");
+    api = element.dataset.api;
+    initMap(element);
+
+    document.getElementById("lookup-form").addEventListener("submit", function (event) {
+        event.preventDefault();
+        var ip = this.elements.input_ip.value.trim();
+        history.pushState(null, "", "?ip=" + encodeURIComponent(ip));
+        lookupIp(ip);
+    });
+    document.getElementById("show-mine").addEventListener("click", function () {
+        history.pushState(null, "", window.location.pathname);
+        lookupMine();
+    });
+    window.addEventListener("popstate", route);
+
+    route();
+});
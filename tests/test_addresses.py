@@ -0,0 +1,102 @@
+import ipaddress
+
+import pytest
+
+import addresses
+
+TRUSTED = addresses.parse_networks('10.0.0.0/8')
+
+
+def test_forwarding_header_ignored_from_untrusted_peer():
+    assert addresses.client_address('203.0.113.9', 'x-forwarded-for', '8.8.8.8', TRUSTED) == '203.0.113.9'
+
+
+def test_x_forwarded_for_walks_trusted_hops():
+    assert addresses.client_address('10.0.0.5', 'x-forwarded-for', '8.8.8.8, 203.0.113.9, 10.0.0.7',
+                                    TRUSTED) == '203.0.113.9'
+
+
+def test_forwarded_header():
+    assert addresses.client_address('10.0.0.5', 'forwarded', 'for=203.0.113.9;proto=https, for="[2001:db8::1]:80"',
+                                    TRUSTED) == '2001:db8::1'
+
+
+
+def test_client_sent_forwarded_is_not_believed_behind_x_forwarded_for_proxy(monkeypatch):
+    import geolocation
+    import ipv4_ipv6_app
+    looked_up = []
+    monkeypatch.setattr(ipv4_ipv6_app, 'TRUSTED_PROXIES', TRUSTED)
+    monkeypatch.setattr(ipv4_ipv6_app, 'TRUSTED_PROXY_HEADER', 'x-forwarded-for')
+    monkeypatch.setattr(geolocation, 'lookup', lambda ip, deadline=None: looked_up.append(ip) or {'ip': ip})
+    with ipv4_ipv6_app.app.test_request_context('/', environ_base={'REMOTE_ADDR': '10.0.0.5'},
+                                                headers={'Forwarded': 'for=8.8.8.8', 'X-Forwarded-For': '203.0.113.9'}):
+        ipv4_ipv6_app.lookup_visitor_ip(None)
+    assert looked_up == ['203.0.113.9']
+
+
+@pytest.mark.parametrize('ip, reason', [
+    ('10.1.2.3', 'Private address (RFC 1918)'),
+    ('100.64.0.1', 'Carrier-grade NAT shared address (RFC 6598)'),
+    ('127.0.0.1', 'Loopback address'),
+    ('192.0.2.1', 'Documentation address (TEST-NET-1)'),
+    ('255.255.255.255', 'Limited broadcast address'),
+    ('240.0.0.1', 'Reserved address'),
+    ('::', 'Unspecified address'),
+    ('::1', 'Loopback address'),
+    ('::1.2.3.4', 'Deprecated IPv4-compatible address'),
+    ('2001:db8::1', 'Documentation address'),
+    ('3fff::1', 'Documentation address'),
+    ('2001:10::1', 'Deprecated ORCHID address'),
+    ('2001:20::1', 'ORCHIDv2 address'),
+    ('fc00::1', 'Unique local address'),
+    ('fe80::1', 'Link-local address'),
+    ('fec0::1', 'Deprecated site-local address'),
+    ('ff02::1', 'Multicast address'),
+    ('8.8.8.8', None),
+    ('2606:4700:4700::1111', None),
+])
+def test_special_use_reasons(ip, reason):
+    assert addresses.special_use(ipaddress.ip_address(ip)) == reason
+
+
+@pytest.mark.parametrize('ip, reason', [
+    ('10.0.0.1', 'Reserved address'),
+    ('2001:db8::1', 'Reserved address'),
+    ('fec0::1', 'Reserved address'),
+    ('8.8.8.8', None),
+    ('2001:4860:4860::8888', None),
+])
+def test_unnamed_special_ranges_fall_back_to_ipaddress(monkeypatch, ip, reason):
+    monkeypatch.setattr(addresses, 'SPECIAL_NETWORKS', [])
+    assert addresses.special_use(ipaddress.ip_address(ip)) == reason
+
+
+@pytest.mark.parametrize('ip, expected', [
+    # Spelling: whitespace, brackets, zone ids, case and leading zeros
+    (' 8.8.8.8\n', '8.8.8.8'),
+    ('[2001:4860:4860::8888]', '2001:4860:4860::8888'),
+    ('2001:4860:4860:0000:0000:0000:0000:8888', '2001:4860:4860::8888'),
+    ('2001:4860:4860::8888'.upper(), '2001:4860:4860::8888'),
+    ('fe80::1%eth0', 'fe80::1'),
+    ('[fe80::1%eth0]', 'fe80::1'),
+    # IPv6 addresses that carry an IPv4 address are unwrapped to it
+    ('::ffff:8.8.8.8', '8.8.8.8'),
+    ('::ffff:808:808', '8.8.8.8'),
+    ('2002:808:808::1', '8.8.8.8'),
+    ('2001:0:4136:e378:8000:63bf:3fff:fdd2', '192.0.2.45'),
+    ('64:ff9b::8.8.8.8', '8.8.8.8'),
+    # ... and nothing else is
+    ('64:ff9b:1::808:808', '64:ff9b:1::808:808'),
+    ('::8.8.8.8', '::808:808'),
+    ('2606:4700:4700::1111', '2606:4700:4700::1111'),
+    ('2001:db8::808:808', '2001:db8::808:808'),
+])
+def test_parse_canonicalizes(ip, expected):
+    assert str(addresses.parse(ip)) == expected
+
+
+@pytest.mark.parametrize('ip', ['', None, 'example.com', '8.8.8', '8.8.8.8/24', '8.8.8.8, 1.1.1.1', '[8.8.8.8'])
+def test_parse_rejects(ip):
+    with pytest.raises(ValueError):
+        addresses.parse(ip)
@@ -0,0 +1,40 @@
+import assets
+import ipv4_ipv6_app
+
+
+def test_compressed_shell_revalidates():
+    client = ipv4_ipv6_app.app.test_client()
+    response = client.get('/', headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+
+    revalidated = client.get('/', headers={'Accept-Encoding': 'gzip', 'If-None-Match': response.headers['ETag']})
+    assert revalidated.status_code == 304
+    assert revalidated.data == b''
+
+
+def test_uncompressed_shell_revalidates():
+    client = ipv4_ipv6_app.app.test_client()
+    response = client.get('/')
+    assert 'Content-Encoding' not in response.headers
+    assert client.get('/', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+
+
+def test_form_post_redirects_to_a_page_that_explains_it_needs_javascript():
+    client = ipv4_ipv6_app.app.test_client()
+    response = client.post('/get_ip_info', data={'input_ip': '8.8.8.8'})
+    assert response.status_code == 303
+    assert response.headers['Location'] == '/?ip=8.8.8.8'
+    assert b'<noscript>' in client.get(response.headers['Location']).data
+
+
+def test_stylesheet_loads_the_vendored_font_by_its_fingerprinted_name():
+    client = ipv4_ipv6_app.app.test_client()
+    font = assets.manifest.fingerprinted('vendor/montserrat/montserrat-400.woff2')
+    css = client.get('/assets/' + assets.manifest.fingerprinted('css/style.css')).get_data(as_text=True)
+    assert f"url(../{font})" in css
+
+    response = client.get('/assets/' + font)
+    assert response.status_code == 200
+    assert response.mimetype == 'font/woff2'
+    assert response.data[:4] == b'wOF2'
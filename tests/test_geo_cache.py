@@ -0,0 +1,14 @@
+from geo_cache import SQLiteCache
+
+
+def test_sqlite_cache_purges_unservable_rows_every_n_writes(tmp_path):
+    cache = SQLiteCache(str(tmp_path / 'geo.sqlite3'), ttl=60, purge_every=3, purge_grace=10)
+    cache.set('dead', {'ip': '1'}, ttl=-20)
+    cache.set('stale', {'ip': '2'}, ttl=-5)
+    assert cache.get('dead', max_stale=100) is not None
+    cache.set('fresh', {'ip': '3'})
+
+    assert cache.get('dead', max_stale=100) is None
+    assert cache.get('stale', max_stale=100)[0] == {'ip': '2'}
+    assert cache.get('fresh')[0] == {'ip': '3'}
+    assert cache.stats()['purged'] == 1
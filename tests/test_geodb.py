@@ -0,0 +1,71 @@
+import pytest
+
+import geodb
+
+HEADER = 'start,end,city,region,country_name,latitude,longitude,org,asn\n'
+ROWS = [
+    '0.0.0.0,0.0.0.255,Zero,Z,Nowhere,1.5,-2.25,Zero Org,AS1',
+    '1.0.0.0,1.0.0.255,Brisbane,Queensland,Australia,-27.4679,153.0281,APNIC,AS13335',
+    '255.255.255.0,255.255.255.255,Top,T,Edge,,,,',
+    '::,::ff,V6 Zero,,Nowhere,10,20,,',
+    # Crosses the boundary between the high and low 64-bit halves
+    '2001:db8:0:0:ffff:ffff:ffff:ff00,2001:db8:0:1::ff,Split,S,Testland,51.5,-0.1275,Split Org,AS64500',
+    'ffff:ffff:ffff:ffff:ffff:ffff:ffff:ff00,ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff,V6 Top,,Edge,-45,170,,AS2',
+]
+QUERIES = [
+    '0.0.0.0', '0.0.0.255', '0.0.1.0', '1.0.0.0', '1.0.0.128', '1.0.0.255', '1.0.1.0', '128.0.0.1',
+    '255.255.254.255', '255.255.255.0', '255.255.255.255',
+    '::', '::ff', '::100', '2001:db8::ffff:ffff:ffff:feff', '2001:db8::ffff:ffff:ffff:ff00',
+    '2001:db8:0:0:ffff:ffff:ffff:ffff', '2001:db8:0:1::', '2001:db8:0:1::ff', '2001:db8:0:1::100',
+    'ffff:ffff:ffff:ffff:ffff:ffff:ffff:feff', 'ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff',
+]
+
+
+@pytest.fixture
+def databases(tmp_path):
+    csv_path = tmp_path / 'ranges.csv'
+    # Rows out of order, as build and from_csv must sort them
+    csv_path.write_text(HEADER + '\n'.join(reversed(ROWS)) + '\n')
+    bin_path = tmp_path / 'ranges.bin'
+    assert geodb.build(str(csv_path), str(bin_path))[:2] == (3, 3)
+    mapped = geodb.open_db(str(bin_path))
+    yield geodb.open_db(str(csv_path)), mapped
+    mapped.close()
+
+
+def test_binary_database_matches_csv_database(databases):
+    local, mapped = databases
+    assert isinstance(mapped, geodb.MappedGeoDB)
+    for ip in QUERIES:
+        assert mapped.lookup(ip) == local.lookup(ip), ip
+
+
+def test_lookups(databases):
+    for db in databases:
+        assert db.lookup('1.0.0.128')['city'] == 'Brisbane'
+        assert db.lookup('2001:db8:0:1::')['asn'] == 'AS64500'
+        assert db.lookup('1.0.1.0') is None
+        assert db.lookup('2001:db8:0:1::100') is None
+    info = databases[1].lookup('1.0.0.1')
+    assert (info['latitude'], info['longitude']) == (-27.4679, 153.0281)
+
+
+def test_unknown_coordinates_round_trip_as_none(databases):
+    for db in databases:
+        info = db.lookup('255.255.255.255')
+        assert info['latitude'] is None and info['longitude'] is None
+        assert info['org'] == ''
+
+
+def test_overlapping_ranges_rejected(tmp_path):
+    csv_path = tmp_path / 'overlap.csv'
+    csv_path.write_text(HEADER + '1.0.0.0,1.0.0.255,A,,,,,,\n1.0.0.128,1.0.1.0,B,,,,,,\n')
+    with pytest.raises(ValueError, match='Overlapping IPv4 ranges at 1.0.0.128'):
+        geodb.build(str(csv_path), str(tmp_path / 'overlap.bin'))
+
+
+def test_non_database_file_is_not_mapped(tmp_path):
+    path = tmp_path / 'junk.bin'
+    path.write_bytes(b'x' * geodb.HEADER.size)
+    with pytest.raises(ValueError):
+        geodb.MappedGeoDB(str(path))
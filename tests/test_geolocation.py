@@ -0,0 +1,107 @@
+import threading
+import time
+
+import pytest
+
+import addresses
+import geolocation
+
+
+@pytest.fixture
+def upstream_calls(monkeypatch):
+    calls = []
+
+    def fetch(ip, priority, deadline=None):
+        calls.append(ip)
+        time.sleep(0.01)
+        return {'ip': ip, 'city': 'Mountain View'}
+    monkeypatch.setattr(geolocation, 'fetch', fetch)
+    monkeypatch.setattr(geolocation, 'disk_cache', None)
+    geolocation.cache.clear()
+    yield calls
+    geolocation.cache.clear()
+
+
+def test_lookup_many_fetches_a_network_once(upstream_calls):
+    results = geolocation.lookup_many([f'8.8.8.{i}' for i in range(40)])
+    assert len(upstream_calls) == 1
+    assert [info['ip'] for info in results] == [f'8.8.8.{i}' for i in range(40)]
+
+
+def test_lookup_stream_fetches_a_network_once(upstream_calls):
+    results = list(geolocation.lookup_stream(f'8.8.4.{i}' for i in range(40)))
+    assert len(upstream_calls) == 1
+    assert all(info['city'] == 'Mountain View' for info in results)
+
+
+def test_lookup_many_answers_align_with_input(upstream_calls):
+    ips = ['::ffff:8.8.8.8', 'not an address', '8.8.8.8', '10.0.0.1', '::ffff:8.8.8.8']
+    results = geolocation.lookup_many(ips)
+    assert len(upstream_calls) == 1
+    assert [info['ip'] for info in results] == ['8.8.8.8', 'not an address', '8.8.8.8', '10.0.0.1', '8.8.8.8']
+    assert [info.get('error', False) for info in results] == [False, True, False, True, False]
+
+
+class Outage(Exception):
+    pass
+
+
+@pytest.fixture
+def stale_setup(monkeypatch, tmp_path):
+    # Entries are fresh for 60 s, served stale while revalidating for 50 s past that and during an outage for 100 s
+    monkeypatch.setattr(geolocation, 'GEO_CACHE_STALE_WHILE_REVALIDATE', 50)
+    monkeypatch.setattr(geolocation, 'GEO_CACHE_STALE_IF_ERROR', 100)
+    monkeypatch.setattr(geolocation, 'cache', geolocation.TTLCache(100, 60, stale_ttl=100))
+    monkeypatch.setattr(geolocation, 'disk_cache', geolocation.SQLiteCache(str(tmp_path / 'geo.sqlite3'), 60))
+    upstream = {'calls': 0, 'down': False, 'release': threading.Event()}
+
+    def fetch(ip, priority, deadline=None):
+        upstream['calls'] += 1
+        upstream['release'].wait(5)
+        if upstream['down']:
+            raise Outage('upstream down')
+        return {'ip': ip, 'city': 'New'}
+    monkeypatch.setattr(geolocation, 'fetch', fetch)
+    upstream['key'] = geolocation.cache_key(addresses.parse('8.8.8.8'))
+    return upstream
+
+
+def test_stale_entry_served_while_one_background_refresh_runs(stale_setup):
+    geolocation.cache.set(stale_setup['key'], {'ip': '8.8.8.0', 'city': 'Old'}, ttl=-5)
+    for _ in range(3):
+        assert geolocation.lookup('8.8.8.8')['city'] == 'Old'
+    time.sleep(0.05)
+    assert stale_setup['calls'] == 1
+
+    stale_setup['release'].set()
+    for _ in range(100):
+        if not geolocation._refreshing:
+            break
+        time.sleep(0.01)
+    assert geolocation.lookup('8.8.8.8')['city'] == 'New'
+    assert stale_setup['calls'] == 1
+
+
+def test_outage_served_from_memory(stale_setup):
+    stale_setup['down'] = True
+    stale_setup['release'].set()
+    geolocation.cache.set(stale_setup['key'], {'ip': '8.8.8.0', 'city': 'Old'}, ttl=-70)
+    assert geolocation.lookup('8.8.8.8') == {'ip': '8.8.8.8', 'city': 'Old'}
+    assert stale_setup['calls'] == 1
+
+
+def test_outage_served_from_disk(stale_setup):
+    stale_setup['down'] = True
+    stale_setup['release'].set()
+    geolocation.disk_cache.set(stale_setup['key'], {'ip': '8.8.8.0', 'city': 'Old'}, ttl=-70)
+    assert geolocation.lookup('8.8.8.8') == {'ip': '8.8.8.8', 'city': 'Old'}
+    assert stale_setup['calls'] == 1
+
+
+def test_entry_past_stale_if_error_window_raises(stale_setup):
+    stale_setup['down'] = True
+    stale_setup['release'].set()
+    geolocation.cache.set(stale_setup['key'], {'ip': '8.8.8.0', 'city': 'Old'}, ttl=-150)
+    geolocation.disk_cache.set(stale_setup['key'], {'ip': '8.8.8.0', 'city': 'Old'}, ttl=-150)
+    with pytest.raises(Outage):
+        geolocation.lookup('8.8.8.8')
@@ -0,0 +1,184 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import providers
+import upstream
+
+
+def answer(payload, status=200):
+    return status, {'Content-Type': 'application/json'}, json.dumps(payload).encode()
+
+
+def test_probe_cut_short_by_deadline_is_probed_again(stand_in):
+    mode = {'value': 'fail'}
+
+    def handler(request):
+        if mode['value'] == 'fail':
+            return answer({}, 500)
+        if mode['value'] == 'hang':
+            time.sleep(1)
+        return answer({'ip': '8.8.8.8', 'city': 'Mountain View'})
+
+    provider = providers.IpapiProvider(base_url=stand_in(handler), rate=100, burst=100)
+    router = providers.Router([provider], failure_threshold=2, cooldown=0.1)
+    for _ in range(2):
+        with pytest.raises(providers.ProviderError):
+            router.fetch('8.8.8.8')
+    assert router.stats()['ipapi']['circuit'] == 'open'
+
+    time.sleep(0.15)
+    mode['value'] = 'hang'
+    with pytest.raises(upstream.DeadlineExceeded):
+        router.fetch('8.8.8.8', deadline=upstream.Deadline(0.3))
+
+    mode['value'] = 'ok'
+    time.sleep(0.15)
+    assert router.fetch('8.8.8.8')['city'] == 'Mountain View'
+    assert router.stats()['ipapi']['circuit'] == 'closed'
+
+
+def test_adapters_normalise_their_payloads(stand_in):
+    payloads = {
+        '/8.8.8.8/json/': {'ip': '8.8.8.8', 'city': 'Mountain View', 'region': 'California',
+                           'country_name': 'United States', 'latitude': 37.4, 'longitude': -122.1,
+                           'org': 'Google LLC', 'asn': 'AS15169'},
+        '/8.8.8.8': {'success': True, 'ip': '8.8.8.8', 'city': 'Mountain View', 'region': 'California',
+                     'country': 'United States', 'latitude': 37.4, 'longitude': -122.1,
+                     'connection': {'asn': 15169, 'org': 'Google LLC'}},
+        '/json/8.8.8.8': {'status': 'success', 'query': '8.8.8.8', 'city': 'Mountain View',
+                          'regionName': 'California', 'country': 'United States', 'lat': 37.4, 'lon': -122.1,
+                          'org': 'Google LLC', 'as': 'AS15169 Google LLC'},
+        '/8.8.8.8/json': {'ip': '8.8.8.8', 'city': 'Mountain View', 'region': 'California',
+                          'country': 'United States', 'loc': '37.4,-122.1', 'org': 'AS15169 Google LLC'},
+    }
+    url = stand_in(lambda request: answer(payloads[request.path.split('?')[0]]))
+    for cls in providers.PROVIDERS.values():
+        info = cls(base_url=url).fetch('8.8.8.8')
+        assert info == {'ip': '8.8.8.8', 'city': 'Mountain View', 'region': 'California',
+                        'country_name': 'United States', 'latitude': 37.4, 'longitude': -122.1,
+                        'org': 'Google LLC', 'asn': 'AS15169'}, cls.name
+
+
+def test_rate_limited_provider_pauses_its_bucket(stand_in):
+    url = stand_in(lambda request: (429, {'Retry-After': '30'}, b''))
+    provider = providers.IpwhoisProvider(base_url=url)
+    with pytest.raises(providers.ProviderError):
+        provider.fetch('8.8.8.8')
+    assert provider.bucket.stats()['pauses'] == 1
+
+
+def test_breaker_opens_and_router_fails_over(stand_in):
+    broken = providers.IpapiProvider(base_url=stand_in(lambda request: answer({}, 503)), rate=100, burst=100)
+    working = providers.IpwhoisProvider(base_url=stand_in(lambda request: answer({'ip': '8.8.8.8', 'city': 'X'})),
+                                        rate=100, burst=100)
+    router = providers.Router([broken, working], failure_threshold=3, cooldown=60)
+    for _ in range(3):
+        assert router.fetch('8.8.8.8')['city'] == 'X'
+    stats = router.stats()
+    assert stats['ipapi']['circuit'] == 'open'
+    assert stats['ipapi']['failures'] == 3
+    assert router.candidates() == [working]
+
+
+def test_often_failing_fast_provider_ranks_after_reliable_one():
+    fast = providers.IpapiProvider(base_url='http://127.0.0.1:9')
+    reliable = providers.IpwhoisProvider(base_url='http://127.0.0.1:9')
+    router = providers.Router([fast, reliable], failure_threshold=5)
+    for _ in range(10):
+        router.record(reliable, 0.2, failed=False)
+        # Fails 4 times out of 5, never 5 in a row, so its circuit stays closed
+        for failed in (True, True, True, True, False):
+            router.record(fast, 0.05, failed=failed)
+    assert router.stats()['ipapi']['circuit'] == 'closed'
+    assert router.candidates() == [reliable, fast]
+
+
+def _hedging_router(stand_in, hedge_ratio):
+    def slow(request):
+        time.sleep(1)
+        return answer({'ip': '8.8.8.8', 'city': 'Slow'})
+    first = providers.IpapiProvider(base_url=stand_in(slow), rate=100, burst=100)
+    second = providers.IpwhoisProvider(base_url=stand_in(lambda request: answer({'ip': '8.8.8.8', 'city': 'Fast'})),
+                                       rate=100, burst=100)
+    router = providers.Router([first, second], hedge=True, hedge_ratio=hedge_ratio)
+    for _ in range(providers.HEDGE_MIN_SAMPLES):
+        router.record(first, 0.05, failed=False)
+        router.record(second, 0.1, failed=False)
+    return router
+
+
+def test_slow_primary_is_hedged(stand_in):
+    router = _hedging_router(stand_in, hedge_ratio=1)
+    start = time.monotonic()
+    assert router.fetch('8.8.8.8')['city'] == 'Fast'
+    assert time.monotonic() - start < 0.5
+    assert router.stats()['hedging']['hedge_wins'] == 1
+
+
+def test_lookup_without_hedge_budget_runs_on_callers_thread(stand_in, monkeypatch):
+    router = _hedging_router(stand_in, hedge_ratio=0)
+    monkeypatch.setattr(router._primary_pool, 'submit', lambda *args: pytest.fail('primary left the caller thread'))
+    assert router.fetch('8.8.8.8')['city'] == 'Slow'
+    assert router.stats()['hedging']['hedges'] == 0
+
+
+def test_primaries_never_queue_for_a_busy_primary_pool(stand_in):
+    router = _hedging_router(stand_in, hedge_ratio=1)
+    router._primary_slots = threading.BoundedSemaphore(1)
+    with ThreadPoolExecutor(max_workers=4) as callers:
+        results = list(callers.map(lambda _: router.fetch('8.8.8.8')['city'], range(4)))
+    # One caller got the primary worker and was hedged; the rest ran inline, unhedged, on their own threads
+    assert sorted(results) == ['Fast', 'Slow', 'Slow', 'Slow']
+    assert router.stats()['hedging']['hedges'] == 1
+
+
+@pytest.mark.parametrize('cls, quota, window', [
+    (providers.IpapiProvider, 1000, providers.DAY),
+    (providers.IpwhoisProvider, 10000, providers.MONTH),
+    (providers.IpApiComProvider, 45, 60),
+    (providers.IpinfoProvider, 50000, providers.MONTH),
+])
+def test_default_budget_stays_within_free_tier(cls, quota, window):
+    provider = cls()
+    assert provider.bucket.burst + provider.bucket.rate * window <= quota + 1e-6
+
+
+def test_budget_overridden_from_env(monkeypatch):
+    monkeypatch.setenv('IPAPI_RATE', '5')
+    monkeypatch.setenv('IPAPI_BURST', '20')
+    assert providers.from_env('ipapi').bucket.stats()['rate'] == 5
+    assert providers.from_env('ipwhois').bucket.rate == providers.IpwhoisProvider.rate
+
+
+def _spend_budget(rate_state):
+    # One "worker process": takes as many requests as the shared budget admits right now
+    provider = providers.from_env('ipapi', rate_state)
+    granted = 0
+    for _ in range(providers.IpapiProvider.burst * 2):
+        try:
+            provider.bucket.acquire(timeout=0)
+        except Exception:
+            break
+        granted += 1
+    return granted
+
+
+def test_budget_is_shared_by_worker_processes(tmp_path):
+    from concurrent.futures import ProcessPoolExecutor
+    rate_state = str(tmp_path / 'ratelimit.sqlite3')
+    with ProcessPoolExecutor(max_workers=3) as pool:
+        granted = list(pool.map(_spend_budget, [rate_state] * 3))
+    assert sum(granted) == providers.IpapiProvider.burst
+
+
+def test_app_providers_share_host_wide_state():
+    import geolocation
+    import ratelimit
+    assert geolocation.GEO_RATE_STATE
+    for provider in geolocation.router.providers:
+        assert isinstance(provider.bucket.state, ratelimit.SQLiteBucketState)
+        assert provider.bucket.state.path == geolocation.GEO_RATE_STATE
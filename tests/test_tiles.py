@@ -0,0 +1,64 @@
+import pytest
+
+import tiles
+
+PNG = b'\x89PNG' + b'\x00' * 996
+
+
+@pytest.fixture
+def tile_server(stand_in, tmp_path, monkeypatch):
+    # Stand-in tile server: answers 200 with an ETag, 304 to a matching If-None-Match, 503 while `down`
+    server = {'down': False, 'requests': []}
+
+    def handler(request):
+        server['requests'].append((request.path, request.headers.get('If-None-Match')))
+        if server['down']:
+            return 503, {}, b''
+        if request.headers.get('If-None-Match') == '"v1"':
+            return 304, {'Cache-Control': 'max-age=0'}, b''
+        return 200, {'ETag': '"v1"', 'Cache-Control': 'max-age=0', 'Content-Type': 'image/png'}, PNG
+
+    monkeypatch.setattr(tiles, 'TILE_UPSTREAM_URL', stand_in(handler) + '/{z}/{x}/{y}.png')
+    monkeypatch.setattr(tiles, 'cache', tiles.TileCache(str(tmp_path), 2500))
+    return server
+
+
+def test_fresh_tile_is_served_from_disk(tile_server, monkeypatch):
+    monkeypatch.setattr(tiles, '_max_age', lambda headers: 3600)
+    assert tiles.tile(1, 0, 1)[0] == PNG
+    assert tiles.tile(1, 0, 1)[0] == PNG
+    assert len(tile_server['requests']) == 1
+    assert tiles.stats()['hits'] == 1
+
+
+def test_expired_tile_is_revalidated(tile_server):
+    tiles.tile(1, 0, 1)
+    data, info = tiles.tile(1, 0, 1)
+    assert data == PNG
+    assert tile_server['requests'][-1] == ('/1/0/1.png', '"v1"')
+    assert tiles.stats()['revalidated'] == 1
+
+
+def test_stale_tile_served_when_tile_server_fails(tile_server):
+    tiles.tile(1, 0, 1)
+    tile_server['down'] = True
+    assert tiles.tile(1, 0, 1)[0] == PNG
+    assert tiles.stats()['stale_served'] == 1
+    with pytest.raises(tiles.TileError):
+        tiles.tile(1, 1, 1)
+
+
+def test_least_recently_used_tiles_evicted_by_size(tile_server, tmp_path):
+    tiles.tile(2, 0, 0)
+    tiles.tile(2, 1, 0)
+    tiles.cache.get((2, 0, 0))
+    tiles.tile(2, 2, 0)
+    assert tiles.stats()['evictions'] == 1
+    assert not (tmp_path / '2' / '1' / '0.png').exists()
+    assert (tmp_path / '2' / '0' / '0.png').exists()
+    assert tiles.TileCache(str(tmp_path), 2500).stats()['tiles'] == 2
+
+
+def test_coordinates_outside_the_map_are_rejected(tile_server):
+    with pytest.raises(ValueError):
+        tiles.tile(1, 2, 0)
@@ -0,0 +1,185 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+
+import upstream
+from geo_cache import SingleFlight
+
+# Tile server the map proxy fetches from; point it at a local stand-in to test without touching OpenStreetMap
+TILE_UPSTREAM_URL = os.environ.get('TILE_UPSTREAM_URL', 'https://tile.openstreetmap.org/{z}/{x}/{y}.png')
+# OpenStreetMap's tile policy requires an identifying User-Agent
+TILE_USER_AGENT = os.environ.get('TILE_USER_AGENT', 'ipv4-ipv6-info tile proxy')
+# Directory and size bound (bytes) of the on-disk tile cache; least recently used tiles are removed beyond it
+TILE_CACHE_DIR = os.environ.get('TILE_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tile_cache'))
+TILE_CACHE_MAX_BYTES = int(os.environ.get('TILE_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+# Seconds a tile is fresh when the tile server sends no max-age; after that it is revalidated with a conditional GET
+TILE_CACHE_TTL = float(os.environ.get('TILE_CACHE_TTL', '604800'))
+TILE_MAX_ZOOM = int(os.environ.get('TILE_MAX_ZOOM', '19'))
+
+_MAX_AGE = re.compile(r'max-age=(\d+)')
+
+
+class TileError(Exception):
+    pass
+
+
+class TileCache:
+    # Tiles stored as <root>/<z>/<x>/<y>.png with a .json sidecar (validators, expiry, digest). The LRU order is
+    # kept in memory; at startup it is rebuilt from the sidecars' modification times
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.revalidated = 0
+        self.stale_served = 0
+        self._load()
+
+    def _paths(self, key):
+        base = os.path.join(self.root, *map(str, key))
+        return base + '.png', base + '.json'
+
+    def _load(self):
+        found = []
+        for directory, _, files in os.walk(self.root):
+            for filename in files:
+                if filename.endswith('.json'):
+                    meta = os.path.join(directory, filename)
+                    png = meta[:-len('.json')] + '.png'
+                    try:
+                        found.append((os.path.getmtime(meta), os.path.getsize(png) + os.path.getsize(meta),
+                                      tuple(int(part) for part in os.path.relpath(png, self.root)[:-len('.png')].split(os.sep))))
+                    except (OSError, ValueError):
+                        continue
+        for _, size, key in sorted(found):
+            self._entries[key] = size
+            self.size += size
+        self._evict()
+
+    def get(self, key):
+        # (data, meta) or None; a tile missing or unreadable on disk counts as a miss
+        png, meta = self._paths(key)
+        try:
+            with open(meta, encoding='utf-8') as f:
+                info = json.load(f)
+            with open(png, 'rb') as f:
+                data = f.read()
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        return data, info
+
+    def set(self, key, data, info):
+        png, meta = self._paths(key)
+        os.makedirs(os.path.dirname(png), exist_ok=True)
+        # Written under temporary names and renamed, so readers in other threads or processes never see half a tile
+        for path, content, mode in ((png, data, 'wb'), (meta, json.dumps(info).encode('utf-8'), 'wb')):
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, mode) as f:
+                f.write(content)
+            os.replace(tmp, path)
+        size = len(data) + os.path.getsize(meta)
+        with self._lock:
+            self.size += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+        self._evict()
+
+    def _evict(self):
+        while True:
+            with self._lock:
+                if self.size <= self.max_bytes or len(self._entries) <= 1:
+                    return
+                key, size = self._entries.popitem(last=False)
+                self.size -= size
+                self.evictions += 1
+            for path in self._paths(key):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def count_revalidated(self):
+        with self._lock:
+            self.revalidated += 1
+
+    def count_stale_served(self):
+        with self._lock:
+            self.stale_served += 1
+
+    def stats(self):
+        with self._lock:
+            return {'tiles': len(self._entries), 'bytes': self.size, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'revalidated': self.revalidated, 'stale_served': self.stale_served}
+
+
+cache = TileCache(TILE_CACHE_DIR, TILE_CACHE_MAX_BYTES)
+# Concurrent requests for the same tile share one upstream fetch
+flights = SingleFlight()
+
+
+def tile(z, x, y):
+    # (png bytes, meta) for one tile, from the disk cache while fresh; ValueError for coordinates outside the map
+    if not (0 <= z <= TILE_MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise ValueError(f"No tile {z}/{x}/{y}")
+    key = (z, x, y)
+    cached = cache.get(key)
+    if cached and cached[1]['expires'] > time.time():
+        return cached
+    return flights.do(key, _fetch, key, cached)
+
+
+def _fetch(key, cached):
+    # Revalidates a stale tile (or fetches a missing one); a stale tile is still served if the tile server fails
+    headers = {'User-Agent': TILE_USER_AGENT}
+    if cached and cached[1].get('etag'):
+        headers['If-None-Match'] = cached[1]['etag']
+    if cached and cached[1].get('last_modified'):
+        headers['If-Modified-Since'] = cached[1]['last_modified']
+    z, x, y = key
+    try:
+        response = upstream.get(TILE_UPSTREAM_URL.format(z=z, x=x, y=y), headers=headers)
+    except requests.RequestException as e:
+        response, error = None, f"Tile server unreachable: {e}"
+    else:
+        error = f"Tile server answered {response.status_code}"
+    expires = time.time() + _max_age(response.headers if response is not None else {})
+    if response is not None and response.status_code == 304 and cached:
+        cache.count_revalidated()
+        data, info = cached[0], dict(cached[1], expires=expires)
+    elif response is not None and response.status_code == 200:
+        data = response.content
+        info = {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified'),
+                'expires': expires, 'digest': hashlib.sha256(data).hexdigest()[:16]}
+    elif cached:
+        cache.count_stale_served()
+        return cached
+    else:
+        raise TileError(error)
+    cache.set(key, data, info)
+    return data, info
+
+
+def _max_age(headers):
+    match = _MAX_AGE.search(headers.get('Cache-Control', ''))
+    return int(match.group(1)) if match else TILE_CACHE_TTL
+
+
+def stats():
+    return dict(cache.stats(), flights=flights.stats())
@@ -0,0 +1,63 @@
+import os
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Number of worker threads that may talk to the upstreams at once; each gets its own kept-alive connection per host
+UPSTREAM_POOL_SIZE = int(os.environ.get('UPSTREAM_POOL_SIZE', '16'))
+# Number of distinct upstream hosts to keep connection pools for (ipify v4, ipify v6, ipapi.co, ...)
+UPSTREAM_POOL_HOSTS = int(os.environ.get('UPSTREAM_POOL_HOSTS', '8'))
+# Ceiling on connect / read timeouts (seconds) for any upstream call, including ones made outside a request
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', '3.05'))
+UPSTREAM_READ_TIMEOUT = float(os.environ.get('UPSTREAM_READ_TIMEOUT', '10'))
+
+
+def _build_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=UPSTREAM_POOL_HOSTS, pool_maxsize=UPSTREAM_POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+# Process-wide session so every lookup reuses pooled keep-alive connections instead of a new TCP+TLS handshake
+session = _build_session()
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline:
+    # Time budget for one incoming request, shared by every upstream call made on its behalf
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def exceeded(self):
+        return DeadlineExceeded(f"Timed out after {self.seconds:g}s")
+
+    def check(self):
+        if self.expired():
+            raise self.exceeded()
+
+    def timeout(self, budget=None):
+        # (connect, read) timeouts for one call: the remaining budget, or `budget` if that is smaller. requests
+        # applies the read timeout per socket read, so a call can only overrun it by trickling bytes
+        self.check()
+        remaining = self.remaining() if budget is None else min(budget, self.remaining())
+        return min(UPSTREAM_CONNECT_TIMEOUT, remaining), min(UPSTREAM_READ_TIMEOUT, remaining)
+
+
+def get(url, deadline=None, budget=None, **kwargs):
+    # Every call gets a timeout, so a hung connection can never pin a worker thread
+    kwargs.setdefault('timeout', deadline.timeout(budget) if deadline else (UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT))
+    return session.get(url, **kwargs)